@@ -1,8 +1,73 @@
 stable_coin_alts={'USD':['USDT','USDC']}
 
 infura_key = ''
+eth_rpc_url = '' # ethereum JSON-RPC endpoint - leave blank to use infura with infura_key
+eth_rpc_batch_size = 100 # JSON-RPC calls per batched request
+# ERC-20 tokens looked up on ETH address wallets - {symbol: (contract address, decimals)}
+erc20_tokens = {
+    'USDC': ('0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48', 6),
+    'USDT': ('0xdAC17F958D2ee523a2206206994597C13D831ec7', 6),
+    'DAI': ('0x6B175474E89094C44Da98b954EedeAC495271d0F', 18),
+    'LINK': ('0x514910771AF9Ca656af840dff83E8264EcF986CA', 18),
+}
 
 fiat_currencies = ['USD','GBP']
 
 remap_assets = {'XDG':'DOGE',
-                'XBT':'BTC'}
\ No newline at end of file
+                'XBT':'BTC'}
+
+# HTTP connection pooling - one keep-alive session per host
+session_pool_connections = 10
+session_pool_maxsize = 20
+request_timeout = (5, 30) # (connect, read) seconds
+async_max_workers = 16 # threads backing the awaitable (*_async) exchange API
+
+# Balance collection - wallets are pulled in parallel, limited per source
+balance_max_workers = 8
+balance_default_concurrency = 4
+balance_source_concurrency = {'kraken': 2, 'coinbase': 2, 'bittrex': 2}
+
+kraken_ticker_max_pairs_length = 1500 # max characters of pair names per Ticker request (keeps urls well within limits)
+bittrex_ticker_ttl = 60 # seconds the Bittrex tickers payload is reused for spot prices
+
+coinbase_page_limit = 100 # records per page for Coinbase cursor pagination
+coinbase_account_workers = 4 # Coinbase accounts whose transactions are pulled at once
+
+reference_cache_ttl = 86400 # seconds public reference responses (asset pairs, products, coin lists) are reused before revalidating
+
+# Request budget per host: (requests per second, burst size)
+rate_limits = {'default': (10, 20),
+               'api.kraken.com': (0.5, 15),
+               'api.coingecko.com': (0.5, 10),
+               'api.coinbase.com': (10, 10),
+               'api.pro.coinbase.com': (3, 6),
+               'api.bittrex.com': (1, 60)}
+rate_limit_max_retries = 3 # retries of a request the host throttled (429)
+
+# Circuit breaker per source - skip a failing source and serve its last known good value
+breaker_failure_threshold = 3 # failures in a row which open the breaker
+breaker_reset_timeout = 60 # seconds before an open breaker lets a trial call through
+
+refresh_deadline = 30 # seconds a dashboard refresh may take - sources which have not answered by then are left out
+
+bittrex_backfill_start_year = 2014 # first year of Bittrex candle history to backfill
+bittrex_backfill_workers = 4 # Bittrex candle years pulled at once
+
+# Address APIs
+address_api_workers = 4 # address requests made at once per asset
+address_api_retries = 2 # extra attempts for a failed address request
+blockchain_max_addresses_length = 1500 # max characters of joined bitcoin addresses per blockchain.info request
+coinexplorer_assets = {'VTC': 'Vertcoin'} # address wallet assets looked up through coinexplorer - {ticker: name}
+
+# Live prices - ticker WebSockets streamed into an in-process price cache (needs websocket-client)
+price_feed_urls = {'kraken': 'wss://ws.kraken.com', 'coinbase': 'wss://ws-feed.pro.coinbase.com'} # blank a url to disable that feed
+price_feed_max_age = 60 # seconds a streamed price is used for before falling back to the REST APIs
+price_feed_reconnect_delay = 1 # seconds before reconnecting a dropped feed (doubles up to a minute)
+
+# Background refresh - balances & prices are precomputed per wallet set off the request path
+refresh_interval = 300 # seconds between background refreshes of a wallet set
+refresh_max_age = 900 # older results are refreshed before the dashboard shows them
+refresh_idle_timeout = 3600 # wallet sets the dashboard has not read for this long stop being refreshed
+
+# Credential vault - decrypted API credentials are kept in memory for signing
+credential_ttl = 3600 # seconds before a decrypted credential is zeroed and has to be decrypted again
\ No newline at end of file
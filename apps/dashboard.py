@@ -1,9 +1,9 @@
 from app import app
 
-from config import fiat_currencies
+from config import fiat_currencies, refresh_interval
 
-from lib.dash_functions import generate_balance_table
-from lib.functions import balances_from_dict, pull_spot_prices_from_all_sources
+from lib.dash_functions import generate_balance_table, generate_refresh_report
+from lib.refresh_worker import refresh_worker
 
 import pandas as pd
 import dash
@@ -70,6 +70,8 @@ tab_Style = {
 layout = html.Div(
     [   dcc.Store(id='daily-prices-df', storage_type='session',clear_data=True),
         dcc.Store(id='balance-df', storage_type='session'),
+        dcc.Store(id='refresh-report', storage_type='session'),
+        dcc.Interval(id='balance-refresh', interval=refresh_interval*1000),
         dcc.Tabs(
             id='db-tab', 
             value='bal', 
@@ -104,22 +106,24 @@ def render_content(tab):
         return html.Div(transactions_content)
 
 @app.callback(
-    Output('balance-df','data'),Output('daily-prices-df','data'),
-    Input('memory', 'data'), Input('encryption-key-set','data'),
-    State('encryption-key','data'),State('balance-df','data'),State('daily-prices-df','data'), 
+    Output('balance-df','data'),Output('daily-prices-df','data'),Output('refresh-report','data'),
+    Input('memory', 'data'), Input('encryption-key-set','data'), Input('balance-refresh','n_intervals'),
+    State('encryption-key','data'),State('balance-df','data'),State('daily-prices-df','data'),State('refresh-report','data'), 
     prevent_initial_call = True
 )
 
-def load_balance_data(data, key_set, stored_key, balance_df, daily_prices_df):
+def load_balance_data(data, key_set, n_intervals, stored_key, balance_df, daily_prices_df, refresh_report):
     """
     updates the balance dataframe
 
     Args:
         data (dict): stored in the id 'memory'
         key_set (bool): whether the key has been set or not, stored in the dcc.Store method
+        n_intervals (int): number of times the balance-refresh interval has fired - picks up the worker's background refreshes
         stored_key (str): stored decryption key
         balance_df (pandas.DataFrame): Stored Dataframe with balances data from Wallets
         daily_prices_df (pandas.DataFrame): Stored Dataframe with prices for listed assets
+        refresh_report (dict): Stored report of the refresh which produced the stored dataframes
 
     Raises:
         PreventUpdate: doesn't update if data is empty
@@ -127,9 +131,9 @@ def load_balance_data(data, key_set, stored_key, balance_df, daily_prices_df):
     Returns:
         json: json panda dataframe object of the balance dataframe
         json: json panda dataframe object of the prices dataframe
+        dict: report of the refresh (sources which missed the deadline etc.)
     """
 
-    native = 'USD'
     ctx = dash.callback_context
     trg = ctx.triggered[0]['prop_id'].split('.')[0]  
     if data is not None:
@@ -138,30 +142,13 @@ def load_balance_data(data, key_set, stored_key, balance_df, daily_prices_df):
                 print(f"loading_balance_data! Triggered: {trg} (triggers: {len(ctx.triggered)})")
                 print(f"trigger reason: {balance_df is None} | {daily_prices_df is None} | ({trg not in [None,'']} & {len(ctx.triggered)==1})")
 
-                # import json
-                # with open("data_file.json", "w") as write_file:
-                #     json.dump(data, write_file, indent=4)
+                # balances & prices are precomputed by the background refresh worker - only a missing or stale wallet set is refreshed here
+                return refresh_worker.get(data, stored_key)
+    return balance_df, daily_prices_df, refresh_report
 
-                bal_df = balances_from_dict(data['Wallets'],stored_key.encode())
-                # bal_df = pd.read_json(balance_df)          
-                bal_df = bal_df.sort_values('Total', ascending=False)      
-
-                if daily_prices_df is not None:
-                    daily_prices_df = pd.read_json(daily_prices_df)
-                else:
-                    daily_prices_df = pd.DataFrame()
-
-                native='USD'
-                price_symbols = [bal for bal in bal_df.index.values if bal != native]
-                daily_prices_df = pull_spot_prices_from_all_sources(price_symbols, data, native=native, spot_df=daily_prices_df)
-
-                return bal_df.to_json(), daily_prices_df.to_json()
-                # return balance_df, daily_prices_df.to_json()
-    return balance_df, daily_prices_df
-
-@app.callback(Output('balances-info', 'children'),Input('balance-df','data'),Input('group-addresses','value'),State('daily-prices-df','data'),State('encryption-key-set','data'), 
+@app.callback(Output('balances-info', 'children'),Input('balance-df','data'),Input('group-addresses','value'),State('daily-prices-df','data'),State('encryption-key-set','data'),State('refresh-report','data'), 
     prevent_initial_call = True)
-def render_balance_data(balance_df,group_addresses,daily_prices_df,key_set):
+def render_balance_data(balance_df,group_addresses,daily_prices_df,key_set,refresh_report):
     """
     render the balance data from the stored json dataframe file
 
@@ -170,6 +157,7 @@ def render_balance_data(balance_df,group_addresses,daily_prices_df,key_set):
         group_addresses (int): Radio button indicator for whether same-asset wallets should be grouped (default opted in on page)
         key_set (bool): whether the key has been set or not, stored in the dcc.Store method
         daily_prices_df (pandas.DataFrame): Stored Dataframe with prices for listed assets
+        refresh_report (dict): Stored report of the refresh - sources it could not use are listed above the table
 
     Returns:
         html children: creates a dash table from the stored data
@@ -183,7 +171,7 @@ def render_balance_data(balance_df,group_addresses,daily_prices_df,key_set):
             prices_df = pd.read_json(daily_prices_df)
 
             # return dbc.Table.from_dataframe(bal_df, striped=True, bordered=False, hover=True, style={'text-align':'center'})
-            return generate_balance_table(bal_df,prices_df,'USD',group_rule)
+            return generate_refresh_report(refresh_report) + [generate_balance_table(bal_df,prices_df,'USD',group_rule)]
 
 if __name__ == '__main__':
     import sys
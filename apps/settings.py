@@ -1,6 +1,6 @@
 from app import app
 from lib.dash_functions import generate_wallet_cards
-from lib.functions import add_entry_to_json, remove_entry_from_json, get_latest_index_from_json, encrypt, settings_default
+from lib.functions import add_entry_to_json, remove_entry_from_json, get_latest_index_from_json, encrypt, settings_default, cache_masked_label
 
 import json
 from datetime import datetime
@@ -196,6 +196,8 @@ def add_or_remove_wallet(n1, n2, n3, n4, exchange, api_key, api_sec, api_pass, b
                         'time_added': datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                     }
                 }
+                # display label is cached now so the settings page never decrypts the new wallet to render it
+                cache_masked_label(exch[exchange], 'APIs', stored_key, api_key)
                 app.logger.info(f"adding entry {exch} to json")
                 app_settings_dict = add_entry_to_json('APIs', exch, app_settings_dict)
                 return bad_address, bad_api_key, bad_api_sec, app_settings_dict
@@ -215,6 +217,7 @@ def add_or_remove_wallet(n1, n2, n3, n4, exchange, api_key, api_sec, api_pass, b
                         'time_added': datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                     }
                 }  
+                cache_masked_label(addr[asset], 'Addresses', stored_key, address)
                 app.logger.info(f"adding entry {addr} to json")
                 app_settings_dict = add_entry_to_json('Addresses', addr, app_settings_dict)
                 return False, bad_api_key, bad_api_sec, app_settings_dict 
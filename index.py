@@ -2,6 +2,8 @@ from app import app
 from apps import dashboard as db, settings as ls
 
 from lib.functions import generate_new_key, settings_default
+from lib.vault import credential_vault
+from lib.refresh_worker import refresh_worker
 
 import dash
 from dash.dependencies import Input, Output, State
@@ -181,9 +183,12 @@ def store_encryption(n1,n2,key_input,stored_key):
             if key_input in [None,'']:
                 return stored_key,False,True
             key = key_input  
-            return key,True,False 
         else:            
             raise PreventUpdate
+        # wallet sets refreshed with the previous key are forgotten and its credentials dropped (and zeroed) from the vault
+        if key != stored_key:
+            refresh_worker.clear()
+            credential_vault.clear()
         return key,True,False
 
     else:
@@ -1,11 +1,60 @@
-from config import infura_key
+from config import infura_key, eth_rpc_url, eth_rpc_batch_size, erc20_tokens, address_api_workers, address_api_retries, blockchain_max_addresses_length
 
-import requests
 import json
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 
-def blockchain_address_api(addresses):
+from lib.exchange import Exchange
+from lib.deadline import DeadlineExceeded, run_in_context
+
+def chunk_addresses(addresses, max_length, separator='|'):
+    """
+    split addresses into chunks whose joined string stays within max_length characters (keeps request urls within limits)
+
+    Args:
+        addresses ([str]): list of addresses
+        max_length (int): most characters of joined addresses per chunk
+        separator (str, optional): string the addresses are joined with. Defaults to '|'.
+
+    Returns:
+        list: list of address lists
+    """
+    chunks = [[]]
+    for address in addresses:
+        if (len(chunks[-1])>0) and (len(separator.join(chunks[-1]+[address])) > max_length):
+            chunks += [[]]
+        chunks[-1] += [address]
+    return [chunk for chunk in chunks if len(chunk)>0]
+
+def retry_call(function, *args, retries=address_api_retries):
     """
-    uses the blockchain.info api to query the current balance for bitcoin addresses
+    call a function, calling it again (with a growing pause) while it fails - None or an exception count as failures
+
+    Args:
+        function (callable): function to call
+        *args: arguments passed to the function
+        retries (int, optional): extra attempts after the first. Defaults to address_api_retries from config.py.
+
+    Returns:
+        object: result of the first successful call, None if every attempt failed
+    """
+    for attempt in range(retries+1):
+        if attempt>0:
+            time.sleep(0.5 * 2**(attempt-1))
+        try:
+            result = function(*args)
+            if result is not None:
+                return result
+        except DeadlineExceeded:
+            raise
+        except Exception as err:
+            print(f"attempt {attempt+1} failed: {err!r}")
+    return None
+
+def blockchain_address_chunk(addresses):
+    """
+    uses the blockchain.info api to query the current balance for one chunk of bitcoin addresses
 
     Args:
         addresses ([str]): list of bitcoin addresses
@@ -13,60 +62,189 @@ def blockchain_address_api(addresses):
     Returns:
         dict: json result from API
     """
-    address_str =''
-    for address in addresses:
-        address_str = '|'.join(addresses)
-    url = f'https://blockchain.info/balance?active={address_str}'
-    response = requests.get(url)
+    url = f"https://blockchain.info/balance?active={'|'.join(addresses)}"
+    response = Exchange.http_request('GET', url)
     if response.status_code == 200: 
         return json.loads(response.text)      
     else:
-        print(f"Did not receieve OK response from {address}. Received: {response.status_code}")
+        print(f"Did not receieve OK response for {len(addresses)} addresses. Received: {response.status_code}")
 
-def infura_eth_address(addresses, infura_key=infura_key):
+def blockchain_address_api(addresses):
     """
-    uses the web3 package and infura provider to query the current balance for ethereum addresses
+    uses the blockchain.info api to query the current balance for bitcoin addresses.
+    Addresses are split into url-sized chunks which are pulled concurrently (and retried independently)
+
+    Args:
+        addresses ([str]): list of bitcoin addresses
+
+    Returns:
+        dict: json result from API - None if any chunk could not be retrieved
+    """
+    chunks = chunk_addresses(addresses, blockchain_max_addresses_length)
+    with ThreadPoolExecutor(max_workers=address_api_workers) as executor:
+        results = list(executor.map(run_in_context(lambda chunk: retry_call(blockchain_address_chunk, chunk)), chunks))
+
+    address_dict = {}
+    for chunk, result in zip(chunks, results):
+        if result is None:
+            print(f"could not retrieve balances for {len(chunk)} bitcoin addresses")
+            return None
+        address_dict.update(result)
+    return {address: address_dict[address] for address in addresses if address in address_dict.keys()}
+
+def eth_rpc_endpoint(infura_key=infura_key):
+    """
+    url of the ethereum JSON-RPC endpoint - eth_rpc_url from config.py if set (e.g. a local node), otherwise infura
+
+    Args:
+        infura_key (str, optional): infura project key. Defaults to infura_key from config.py.
+
+    Returns:
+        str: JSON-RPC endpoint url
+    """
+    if eth_rpc_url not in [None, '']:
+        return eth_rpc_url
+    return f'https://mainnet.infura.io/v3/{infura_key}'
+
+def eth_rpc_post(batch, rpc_url):
+    """
+    send one batch of JSON-RPC calls in a single POST through the pooled session for the endpoint
+
+    Args:
+        batch (list): list of (method, params) e.g. [('eth_getBalance', ['0x...', 'latest'])]
+        rpc_url (str): JSON-RPC endpoint url
+
+    Returns:
+        list: result of each call in the same order as batch (None for a call which returned an error), None if the batch could not be sent
+    """
+    payload = [{'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params} for i, (method, params) in enumerate(batch)]
+    response = Exchange.http_request('POST', rpc_url, json=payload)
+    if response.status_code != 200:
+        print(f"Did not receieve OK response from the ethereum node. Received: {response.status_code}")
+        return None
+    response_json = response.json()
+    if not isinstance(response_json, list):
+        print(f"error: {response_json.get('error', response_json)}")
+        return None
+    replies = {reply.get('id'): reply for reply in response_json}
+    results = []
+    for i in range(len(batch)):
+        reply = replies.get(i, {})
+        if 'error' in reply.keys():
+            print(f"error: {reply['error']}")
+        results += [reply.get('result')]
+    return results
+
+def eth_rpc_batch(calls, rpc_url):
+    """
+    send JSON-RPC calls as batches (eth_rpc_batch_size calls per POST) which are sent concurrently (and retried independently)
+
+    Args:
+        calls (list): list of (method, params) e.g. [('eth_getBalance', ['0x...', 'latest'])]
+        rpc_url (str): JSON-RPC endpoint url
+
+    Returns:
+        list: result of each call in the same order as calls (None for a call which returned an error), None if any batch could not be sent
+    """
+    batches = [calls[start:start+eth_rpc_batch_size] for start in range(0, len(calls), eth_rpc_batch_size)]
+    with ThreadPoolExecutor(max_workers=address_api_workers) as executor:
+        batch_results = list(executor.map(run_in_context(lambda batch: retry_call(eth_rpc_post, batch, rpc_url)), batches))
+
+    results = []
+    for batch, batch_result in zip(batches, batch_results):
+        if batch_result is None:
+            print(f"could not send a batch of {len(batch)} ethereum JSON-RPC calls")
+            return None
+        results += batch_result
+    return results
+
+def erc20_balance_call(token_address, address):
+    """
+    JSON-RPC eth_call for the ERC-20 balanceOf(address) of a token contract
+
+    Args:
+        token_address (str): token contract address
+        address (str): ethereum address holding the token
+
+    Returns:
+        tuple: (method, params) for eth_rpc_batch
+    """
+    data = '0x70a08231' + address.lower().replace('0x', '').zfill(64)
+    return ('eth_call', [{'to': token_address, 'data': data}, 'latest'])
+
+def infura_eth_address(addresses, infura_key=infura_key, tokens=erc20_tokens):
+    """
+    query the current balance for ethereum addresses with batched JSON-RPC calls 
+    (infura, or the node set as eth_rpc_url in config.py).
+    Ether balances (eth_getBalance) and ERC-20 token balances (balanceOf eth_call for every token in erc20_tokens from config.py)
+    are sent in the same batches, so N addresses x M tokens only takes (N x (M+1)) / eth_rpc_batch_size requests
 
     Args:
         addresses ([str]): list of ethereum addresses
+        tokens (dict, optional): {symbol: (contract address, decimals)}. Defaults to erc20_tokens from config.py.
 
     Returns:
-        dict: json result from API
+        dict: {address: {'final_balance': ether balance, 'tokens': {symbol: balance}}} - tokens only lists non-zero balances
     """
-    from web3 import Web3
-    w3 = Web3(Web3.HTTPProvider(f'https://mainnet.infura.io/v3/{infura_key}'))
+    calls = [('eth_getBalance', [address, 'latest']) for address in addresses]
+    calls += [erc20_balance_call(token_address, address) for address in addresses for token_address, _ in tokens.values()]
+    results = eth_rpc_batch(calls, eth_rpc_endpoint(infura_key))
+    if results is None:
+        return None
+
+    token_results = iter(results[len(addresses):])
     address_dict = {}
-    for address in addresses:
-        address_dict[address] = {'final_balance' : w3.fromWei(w3.eth.get_balance(address),'ether')}
+    for address, result in zip(addresses, results[:len(addresses)]):
+        token_balances = {}
+        for symbol, (_, decimals) in tokens.items():
+            token_result = next(token_results)
+            if token_result not in [None, '0x'] and int(token_result, 16) > 0:
+                token_balances[symbol] = Decimal(int(token_result, 16)) / Decimal(10**decimals)
+        if result is not None:
+            address_dict[address] = {'final_balance' : Decimal(int(result, 16)) / Decimal(10**18), 'tokens': token_balances}
     return address_dict
 
+def coinexplorer_address_balance(asset, address):
+    """
+    uses the coin explorer API to retrieve the balance of one address
+
+    Args:
+        asset (str): asset to look up balance for (any asset supported by coinexplorer e.g. VTC)
+        address (str): wallet address to query balance for
+
+    Returns:
+        dict: {'final_balance': balance} for the address, None if it could not be retrieved
+    """
+    response = Exchange.http_request('GET', f'https://www.coinexplorer.net/api/v1/{asset}/address/balance?address={address}')
+    if response.status_code == 200: 
+        response_json = response.json()
+        if ('success' in response_json.keys()) & ('result' in response_json.keys()):
+            return {'final_balance' : response_json['result'][address]}
+        elif ('error' in response_json.keys()) & (response_json['error'] is not None):
+            for err in response_json['error']:
+                print(f"error: {err}")
+    else:
+        print(f"Did not receieve OK response from {address}. Received: {response.status_code}")  
+
 def coinexplorer_addresses_api(asset, addresses):
     """
-    uses the coin explorer API to retrieve prices for specific assets (only VTC supported right now)
+    uses the coin explorer API to retrieve balances for addresses of any coinexplorer asset (listed in coinexplorer_assets in config.py).
+    Addresses are pulled concurrently, each retried independently
 
     Args:
-        asset (str): asset to look up balance for (only VTC supported right now)
+        asset (str): asset to look up balance for e.g. VTC
         addresses ([str]): wallet address to query balance for
 
     Returns:
-        dict: dictionary of balances for the asset and addresses provided
+        dict: dictionary of balances for the asset and addresses provided - None if any address could not be retrieved
     """
-    address_dict = {}
-    if asset != 'VTC': 
-        print(f"asset not supported for coinexplorer")
-        return address_dict
+    with ThreadPoolExecutor(max_workers=address_api_workers) as executor:
+        results = list(executor.map(run_in_context(lambda address: retry_call(coinexplorer_address_balance, asset, address)), addresses))
 
-    api_url = 'https://www.coinexplorer.net/api/v1'
-    for address in addresses:
-        uri_path = f'/{asset}/address/balance?address={address}'
-        response = requests.get(f'{api_url}{uri_path}')
-        if response.status_code == 200: 
-            if ('success' in response.json().keys()) & ('result' in response.json().keys()):
-                address_dict[address] = {'final_balance' : response.json()['result'][address]}
-            elif ('error' in response.json().keys()) & (response.json()['error'] is not None):
-                for err in response.json()['error']:
-                    print(f"error: {err}")
-        else:
-            print(f"Did not receieve OK response from {address}. Received: {response.status_code}")  
-            print(response.json())
+    address_dict = {}
+    for address, result in zip(addresses, results):
+        if result is None:
+            print(f"could not retrieve the {asset} balance for {address}")
+            return None
+        address_dict[address] = result
     return address_dict
\ No newline at end of file
@@ -2,12 +2,15 @@ import hmac
 import hashlib
 import urllib
 import time
-import requests
 import pandas as pd
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.auth import AuthBase
 
-from config import fiat_currencies
-from lib.functions import decrypt
+from config import fiat_currencies, bittrex_ticker_ttl, bittrex_backfill_start_year, bittrex_backfill_workers
 from lib.exchange import Exchange
+from lib.vault import credential_vault
+from lib.deadline import run_in_context
 
 class Bittrex(Exchange):
     def __init__(self, api_key, api_sec, key=''):
@@ -36,31 +39,48 @@ class Bittrex(Exchange):
             hexidecimal key: API hexidecimal signature 
         """
         message = timestamp + url + method.upper() + contenthash
-        sigdigest = hmac.new(decrypt(self.api_sec,self.key), message.encode(), hashlib.sha512).hexdigest()
+        sigdigest = hmac.new(credential_vault.get(self.api_sec,self.key), message.encode(), hashlib.sha512).hexdigest()
         return sigdigest.upper()
+
+    class WalletAuth(AuthBase):
+        def __init__(self, exchange, data):
+            self.exchange = exchange
+            self.data = data
+
+        def __call__(self, request):
+            """
+            Signs the request with a fresh timestamp - requests calls this every time the request is sent, so a retried (throttled) request is never stale
+
+            Args:
+                request (requests.PreparedRequest): API Request.
+
+            Returns:
+                requests.PreparedRequest: updated with authorized headers 
+            """
+            timestamp = str(int(1000*time.time()))
+            contenthash = hashlib.sha512(urllib.parse.urlencode(self.data).encode()).hexdigest()
+            request.headers.update({
+                'Api-Key': credential_vault.get(self.exchange.api_key,self.exchange.key),
+                'Api-Timestamp': timestamp,
+                'Api-Content-Hash': contenthash,
+                'Api-Signature': self.exchange.sign_request(timestamp, request.url, request.method, contenthash)
+            })
+            return request
         
-    def auth_request(self, uri_path, data={}):
+    def auth_request(self, uri_path, data={}, priority=0):
         """
         Submit an authenticated request to the API server
 
         Args:
             uri_path (str): sub path for the aPI call
             data (dict, optional): Data if necessary for the API call. Defaults to {}.
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
 
         Returns:
             response: json response from the requests package (API)
         """
-        timestamp = str(int(1000*time.time()))
-        contenthash = hashlib.sha512(urllib.parse.urlencode(data).encode()).hexdigest()
-        sign = self.sign_request(timestamp, (self.api_url + uri_path), 'GET', contenthash)    
-
-        headers = {}
-        headers['Api-Key'] = decrypt(self.api_key,self.key)
-        headers['Api-Timestamp'] = timestamp
-        headers['Api-Content-Hash'] = contenthash
-        headers['Api-Signature'] = sign
-
-        return requests.get(f"{self.api_url}{uri_path}", headers=headers)
+        auth = self.WalletAuth(self, data)
+        return self.http_request('GET', f"{self.api_url}{uri_path}", priority=priority, auth=auth)
 
     def getBalances(self, refresh=False):
         """
@@ -113,10 +133,11 @@ class Bittrex(Exchange):
             dict: response from the API, loaded into the self.validSymbols variable
         """
         if (refresh == True) or ('validSymbols' not in vars(self)):
-            resp = self.request('/markets/tickers')
+            resp = self.reference_request(f'{self.api_url}/markets/tickers', ttl=bittrex_ticker_ttl, refresh=refresh)
             if resp.status_code == 200: 
                 if len(resp.json())>0:
                     self.validSymbols = resp.json()
+                    self.validSymbols_time = resp.fetched
                     return self.validSymbols
             else: print(f"bad response: {resp.status_code} from API")
         else: return self.validSymbols
@@ -142,6 +163,30 @@ class Bittrex(Exchange):
             return self.validSymbols_universal
         else: return self.validSymbols_universal
 
+    def getSpotPrices(self, symbols, ttl=bittrex_ticker_ttl):
+        """
+        Get the current (last trade) prices for the symbols provided.
+        Prices are read from the tickers payload already pulled for the valid symbols, which is only re-pulled once older than the ttl
+
+        Args:
+            symbols ([str]): trading symbols as XXX/XXX e.g. ['BTC/USD','ETH/USD']
+            ttl (int, optional): seconds the tickers payload is considered fresh. Defaults to bittrex_ticker_ttl from config.py.
+
+        Returns:
+            dict: {symbol: price} from the API
+        """
+        validSymbols = self.getValidSymbols()
+        if (validSymbols is not None) and ((time.time() - self.validSymbols_time) > ttl):
+            validSymbols = self.getValidSymbols(True)
+        sp = {}
+        if validSymbols is not None:
+            tickers = {ticker['symbol']: ticker for ticker in validSymbols}
+            for symbol in symbols:
+                ticker = tickers.get(symbol.replace('/','-'))
+                if (ticker is not None) and (ticker.get('lastTradeRate') is not None):
+                    sp[symbol] = float(ticker['lastTradeRate'])
+        return sp
+
     def getValidAssets_Universal(self, refresh=False):
         """
         Get the valid assets within the exchange via API call (uses the valid Symbols APIs and takes the left pairing)
@@ -160,55 +205,92 @@ class Bittrex(Exchange):
                 return self.validAssets_universal
         else: return self.validAssets_universal
         
-    def getHistoricalPrices(self, symbol):
+    def getHistoricalPricesForYear(self, symbol, year):
         """
-        Get the recent Historical prices for the provided symbol within the exchange via API call
+        Get the Historical prices for the provided symbol within one calendar year via API call
 
         Args:
             symbol (str): trading symbol as XXX-XXX
+            year (int): calendar year of the candles
 
         Returns:
-            dict: response from the API
+            list: response from the API (empty if the market did not trade that year)
+        """
+        # backfill years are bulk work - queued behind balance & price calls to the same host
+        resp = self.request(f"/markets/{symbol}/candles/DAY_1/historical/{year}", priority=1)
+        if resp.status_code == 200: 
+            return resp.json()
+        elif resp.status_code != 404: 
+            print(f"bad response for {symbol} ({year}): {resp.status_code} from API")
+        return []
+
+    def getHistoricalPrices(self, symbol, backfill=False, since=None):
+        """
+        Get the recent Historical prices for the provided symbol within the exchange via API call.
+        With backfill, every calendar year of history is pulled as well (years are pulled concurrently)
+
+        Args:
+            symbol (str): trading symbol as XXX-XXX
+            backfill (bool, optional): pull the historical years as well as the recent candles. Defaults to False.
+            since (datetime, optional): when backfilling, only years from this date onwards are pulled. Defaults to None (from bittrex_backfill_start_year in config.py).
+
+        Returns:
+            list: response from the API
         """
         if symbol in self.getValidSymbols_Universal(False): 
-            # resp = self.request(f"/markets/{symbol}/candles/DAY_1/historical/{year}")
+            candles = []
+            if backfill:
+                first_year = bittrex_backfill_start_year if since is None else max(bittrex_backfill_start_year, pd.Timestamp(since).year)
+                years = range(first_year, datetime.utcnow().year+1)
+                with ThreadPoolExecutor(max_workers=bittrex_backfill_workers) as executor:
+                    for year_candles in executor.map(run_in_context(lambda year: self.getHistoricalPricesForYear(symbol, year)), years):
+                        candles += year_candles
+
             resp = self.request(f"/markets/{symbol}/candles/DAY_1/recent")
             if resp.status_code == 200: 
-                if len(resp.json())>0:
-                    return resp.json()
+                candles += resp.json()
             else: print(f"bad response: {resp.status_code} from API")   
+            if len(candles)>0:
+                return candles
         else:
             print(f"symbol {symbol} not a valid symbol for this exchange")
             return None
     
-    def getHistoricalPricesDataFrame(self,symbol):
+    def getHistoricalPricesDataFrame(self, symbol, backfill=False, since=None):
         """
-        Get the recent Historical prices for the provided symbol within the exchange via API call
+        Get the recent Historical prices for the provided symbol within the exchange via API call. 
+        Candles are deduplicated by day (backfilled years overlap the recent candles) and dated in UTC
 
         Args:
             symbol (str): trading symbol as XXX-XXX
+            backfill (bool, optional): pull the historical years as well as the recent candles. Defaults to False.
+            since (datetime, optional): when backfilling, only years from this date onwards are pulled. Defaults to None.
 
         Returns:
             pandas.DataFrame: response from the API
         """
-        historicalPrices = self.getHistoricalPrices(symbol)        
+        historicalPrices = self.getHistoricalPrices(symbol, backfill, since)        
         if historicalPrices is not None:
             df = pd.DataFrame(historicalPrices, columns=['startsAt', 'open', 'high', 'low', 'close'])
-            df['date'] = pd.to_datetime(df.startsAt)
+            df['date'] = pd.to_datetime(df.startsAt, utc=True)
+            df = df.drop_duplicates('date', keep='last').sort_values('date').reset_index(drop=True)
             return df
     
-    def getHistoricalPricesDataFrame_Universal(self,symbol):
+    def getHistoricalPricesDataFrame_Universal(self, symbol, since=None):
         """
-        Get the recent Historical prices for the provided symbol within the exchange via API call
+        Get the Historical prices for the provided symbol within the exchange via API call.
+        The full history is backfilled when nothing is known yet (no since) or since is older than the recent candles cover
         UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (full history).
 
         Returns:
             pandas.DataFrame: response from the API
         """
-        df = self.getHistoricalPricesDataFrame(symbol.replace('/','-'))
+        backfill = (since is None) or ((datetime.utcnow() - pd.Timestamp(since).to_pydatetime()).days > 360)
+        df = self.getHistoricalPricesDataFrame(symbol.replace('/','-'), backfill, since)
         if df is not None:
             if df.empty == False:
                 df[symbol.replace('-','/')] = (df['high'].astype(float)+df['low'].astype(float))/2  
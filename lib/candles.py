@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import pandas as pd
+from contextlib import closing
+
+from lib.functions import locate_data_file
+
+class CandleStore():
+    def __init__(self, file=None):
+        """
+        Local store of daily prices, one row per source (exchange), symbol and day
+
+        Args:
+            file (str, optional): full path of the SQLite database. Defaults to candles.sqlite within the app data location.
+        """
+        self.file = file if file is not None else locate_data_file('candles.sqlite')
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS candles (
+                    source TEXT NOT NULL,
+                    symbol TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    price REAL,
+                    PRIMARY KEY (source, symbol, date)
+                )
+            """)
+            # symbols whose full history (everything the source serves without a start date) has been stored
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS full_history (
+                    source TEXT NOT NULL,
+                    symbol TEXT NOT NULL,
+                    PRIMARY KEY (source, symbol)
+                )
+            """)
+            conn.commit()
+
+    def connect(self):
+        """
+        Open a connection to the database (connections are not shared between threads)
+
+        Returns:
+            sqlite3.Connection: connection which closes when used as a context manager
+        """
+        return closing(sqlite3.connect(self.file, timeout=30))
+
+    def load(self, source, symbol):
+        """
+        Load the stored daily prices for the symbol
+
+        Args:
+            source (str): exchange the prices came from e.g. 'kraken'
+            symbol (str): trading symbol as XXX/XXX
+
+        Returns:
+            pandas.DataFrame: dataframe of daily prices in a column named after the symbol - indexed by date. None if nothing is stored
+        """
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT date, price FROM candles WHERE source = ? AND symbol = ? ORDER BY date", (source, symbol)
+            ).fetchall()
+        if len(rows) == 0:
+            return None
+        df = pd.DataFrame(rows, columns=['date', symbol])
+        df['date'] = pd.to_datetime(df['date'])
+        return df.set_index('date')
+
+    def save(self, source, symbol, df):
+        """
+        Upsert daily prices for the symbol - days already stored are overwritten
+
+        Args:
+            source (str): exchange the prices came from e.g. 'kraken'
+            symbol (str): trading symbol as XXX/XXX
+            df (pandas.DataFrame): dataframe of daily prices in a column named after the symbol - indexed by date
+        """
+        rows = [(source, symbol, pd.Timestamp(date).strftime('%Y-%m-%d'), float(price))
+            for date, price in df[symbol].dropna().items()
+        ]
+        with self.lock, self.connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO candles (source, symbol, date, price) VALUES (?, ?, ?, ?)", rows)
+            conn.commit()
+    def has_full_history(self, source, symbol):
+        """
+        Whether the full history of the symbol has been stored - if not, older days may be missing before the first stored day
+
+        Args:
+            source (str): exchange the prices came from e.g. 'kraken'
+            symbol (str): trading symbol as XXX/XXX
+
+        Returns:
+            bool: True if the full history has been stored
+        """
+        with self.connect() as conn:
+            row = conn.execute("SELECT 1 FROM full_history WHERE source = ? AND symbol = ?", (source, symbol)).fetchone()
+        return row is not None
+
+    def mark_full_history(self, source, symbol):
+        """
+        Record that the full history of the symbol has been stored
+
+        Args:
+            source (str): exchange the prices came from e.g. 'kraken'
+            symbol (str): trading symbol as XXX/XXX
+        """
+        with self.lock, self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO full_history (source, symbol) VALUES (?, ?)", (source, symbol))
+            conn.commit()
@@ -0,0 +1,161 @@
+import contextvars
+import hashlib
+import threading
+import time
+import requests
+
+from config import breaker_failure_threshold, breaker_reset_timeout
+from lib.functions import load_data_file, save_data_file
+from lib.deadline import DeadlineExceeded
+
+class CircuitBreaker():
+    def __init__(self, name, failure_threshold=breaker_failure_threshold, reset_timeout=breaker_reset_timeout):
+        """
+        Circuit breaker for one source (exchange or address API).
+        After failure_threshold failures in a row the breaker opens and calls to the source are skipped, 
+        once reset_timeout seconds have passed a single trial call is let through - success closes the breaker again
+
+        Args:
+            name (str): source name e.g. 'kraken' or 'btc'
+            failure_threshold (int, optional): failures in a row which open the breaker. Defaults to breaker_failure_threshold from config.py.
+            reset_timeout (int, optional): seconds the breaker stays open before a trial call. Defaults to breaker_reset_timeout from config.py.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a call to the source should be made now
+
+        Returns:
+            bool: False while the breaker is open (and a trial call is not due)
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if ((time.time() - self.opened_at) >= self.reset_timeout) and (self.trial_running == False):
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        """
+        The source answered - close the breaker
+        """
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def release(self):
+        """
+        The call was abandoned without an answer either way - allow the next trial call
+        """
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        """
+        The source failed or timed out - open the breaker once failures reach the threshold (or a trial call failed)
+        """
+        with self.lock:
+            self.failures += 1
+            if (self.failures >= self.failure_threshold) or self.trial_running:
+                if self.opened_at is None:
+                    print(f"circuit breaker opened for {self.name} after {self.failures} failures")
+                self.opened_at = time.time()
+            self.trial_running = False
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+# Outages (transport errors, timeouts, 5xx and still-throttled responses) seen by http_request during the current call_with_breaker call
+current_outages = contextvars.ContextVar('current_outages', default=None)
+
+def record_outage(reason):
+    """
+    Note that the source being called is unavailable - only these count towards opening its breaker
+
+    Args:
+        reason (str): description of the outage e.g. '503 from api.kraken.com'
+    """
+    outages = current_outages.get()
+    if outages is not None:
+        outages.append(reason)
+
+def get_breaker(source):
+    """
+    Get the circuit breaker shared by every call to the source
+
+    Args:
+        source (str): source name e.g. 'kraken' or 'btc'
+
+    Returns:
+        CircuitBreaker: breaker for the source
+    """
+    with breakers_lock:
+        if source not in breakers:
+            breakers[source] = CircuitBreaker(source)
+        return breakers[source]
+
+def call_with_breaker(source, cache_key, function, *args):
+    """
+    Call a source through its circuit breaker. A successful result is kept as the last known good value for the cache_key, 
+    when the source is unavailable (transport error, timeout, 5xx or throttled response) or its breaker is open the last known good value is served instead, marked as stale.
+    Other failures (e.g. a revoked API key or a wrong decryption key) are the wallet's own - they are returned/raised as failures without tripping the breaker
+
+    Args:
+        source (str): source name e.g. 'kraken' or 'btc'
+        cache_key (str): identifies the request (e.g. the wallet) the last known good value belongs to
+        function (callable): function calling the source
+        *args: arguments passed to the function
+
+    Raises:
+        Exception: any error from the function which is not a source outage (e.g. cryptography.fernet.InvalidToken)
+
+    Returns:
+        object: result of the function, or the last known good value (None if there is none)
+        float: time the returned value was retrieved if it is stale, None if it is fresh
+    """
+    breaker = get_breaker(source)
+    last_good_file = ('last_good', f"{hashlib.sha256(f'{source}:{cache_key}'.encode()).hexdigest()}.pkl")
+
+    if breaker.allow():
+        outages = []
+        token = current_outages.set(outages)
+        try:
+            result = function(*args)
+            if result is not None:
+                breaker.record_success()
+                save_data_file({'value': result, 'time': time.time()}, *last_good_file)
+                return result, None
+            if len(outages) == 0:
+                # the source answered but had nothing for this wallet - report it, the source itself is fine
+                breaker.release()
+                print(f"{source} returned nothing for this wallet (not counted as an outage)")
+                return None, None
+            print(f"{source} unavailable: {outages[-1]}")
+            breaker.record_failure()
+        except DeadlineExceeded:
+            # the refresh ran out of time - not a fault of the source
+            breaker.release()
+        except requests.exceptions.RequestException as err:
+            print(f"{source} unavailable: {err!r}")
+            breaker.record_failure()
+        except Exception:
+            breaker.release()
+            raise
+        finally:
+            current_outages.reset(token)
+    else:
+        print(f"circuit breaker open for {source}, skipping")
+
+    last_good = load_data_file(*last_good_file)
+    if last_good is None:
+        return None, None
+    return last_good['value'], last_good['time']
@@ -1,13 +1,15 @@
 import hmac
 import hashlib
 import time
-import requests
+import urllib.parse
 import pandas as pd
 from requests.auth import AuthBase
+from concurrent.futures import ThreadPoolExecutor
 
-from config import fiat_currencies
-from lib.functions import decrypt
-from lib.exchange import Exchange
+from config import fiat_currencies, coinbase_page_limit, coinbase_account_workers
+from lib.exchange import Exchange, IncompletePages
+from lib.vault import credential_vault
+from lib.deadline import run_in_context
 
 class Coinbase(Exchange):
     def __init__(self, api_key, api_sec, key=''):
@@ -41,42 +43,72 @@ class Coinbase(Exchange):
             """      
             timestamp = str(int(time.time()))
             message = timestamp + request.method + request.path_url + (request.body or '')
-            signature = hmac.new(decrypt(self.api_sec,self.key), message.encode(), hashlib.sha256).hexdigest()
+            signature = hmac.new(credential_vault.get(self.api_sec,self.key), message.encode(), hashlib.sha256).hexdigest()
 
             request.headers.update({
                 'CB-ACCESS-SIGN': signature,
                 'CB-ACCESS-TIMESTAMP': timestamp,
-                'CB-ACCESS-KEY': decrypt(self.api_key,self.key),
+                'CB-ACCESS-KEY': credential_vault.get(self.api_key,self.key),
                 'CB-VERSION': '2016-05-13'
             })
             return request 
             
-    def pro_request(self, uri_path):
+    def pro_request(self, uri_path, priority=0):
         """
         API request to the api_url already within the class (self.api_url)
 
         Args:
             uri_path (str): sub path for the api call
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
 
         Returns:
             response: json response from the requests package (API)
         """
-        return requests.get(f"{self.api_url_pro}{uri_path}")
+        return self.http_request('GET', f"{self.api_url_pro}{uri_path}", priority=priority)
 
-    def auth_request(self, uri_path, data={}):
+    def auth_request(self, uri_path, data={}, priority=0):
         """
         Submit an authenticated request to the API server
 
         Args:
             uri_path (str): sub path for the API call
             data (dict, optional): Data if necessary for the API call. Defaults to {}.
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
 
         Returns:
             response: json response from the requests package (API)
         """
         auth = self.WalletAuth(self.api_key, self.api_sec, self.key)
-        return requests.get((self.api_url + uri_path),data=data,auth=auth)
+        return self.http_request('GET', (self.api_url + uri_path), priority=priority, data=data, auth=auth)
     
+    def iterPages(self, uri_path):
+        """
+        Follow the cursor pagination (pagination.next_uri) of an authenticated API call, yielding each page as it arrives
+
+        Args:
+            uri_path (str): sub path for the API call, including any query parameters
+
+        Raises:
+            IncompletePages: a page could not be retrieved - the pages already yielded are not the full result
+
+        Yields:
+            dict: json response from the API for each page
+        """
+        api_path = urllib.parse.urlsplit(self.api_url).path
+        while uri_path is not None:
+            resp = self.auth_request(uri_path)
+            if resp.status_code != 200:
+                raise IncompletePages(f"bad response: {resp.status_code} from API for {uri_path}")
+            resp_json = resp.json()
+            if 'data' not in resp_json.keys():
+                raise IncompletePages(f"error: {resp_json.get('errors', resp_json.get('error', []))} for {uri_path}")
+            yield resp_json
+
+            next_uri = (resp_json.get('pagination') or {}).get('next_uri')
+            if next_uri in [None, '']:
+                return
+            uri_path = next_uri[len(api_path):] if next_uri.startswith(api_path) else next_uri
+
     def getAccounts(self, refresh=False):
         """
         Get the Wallet-Accounts associated with the API account within the exchange
@@ -88,16 +120,14 @@ class Coinbase(Exchange):
             dict: response from the API, loaded into the self.accounts variable
         """
         if (refresh == True) or ('accounts' not in vars(self)):
-            resp = self.auth_request('/accounts')
-            # resp = self.auth_request('/accounts',{'limit' : 100,'order' : 'desc'})
-            if resp.status_code == 200: 
-                if 'data' in resp.json().keys():
-                    self.accounts = resp.json()
-                    return self.accounts
-                elif 'error' in resp.json().keys():
-                    for err in resp.json()['error']:
-                        print(f"error: {err}")
-            else: print(f"bad response: {resp.status_code} from API")
+            try:
+                pages = list(self.iterPages(f'/accounts?limit={coinbase_page_limit}'))
+            except IncompletePages as err:
+                print(err)
+                return None
+            if len(pages)>0:
+                self.accounts = {'data' : [account for page in pages for account in page['data']]}
+                return self.accounts
         else: return self.accounts
         
     def getBalances_Universal(self, refresh=False):
@@ -156,7 +186,7 @@ class Coinbase(Exchange):
             list: response from the API, loaded into the self.validSymbols_universal variable
         """
         if (refresh == True) or ('validSymbols_universal' not in vars(self)):
-            resp = self.pro_request(f"/products")
+            resp = self.reference_request(f"{self.api_url_pro}/products", refresh=refresh)
             if resp.status_code == 200: 
                 if len(resp.json())>0:
                     self.validSymbols_universal = [product['display_name'] for product in resp.json()]
@@ -174,43 +204,84 @@ class Coinbase(Exchange):
             dict: response from the API
         """
         resp = self.request(f"/prices/{symbol.replace('/','-')}/spot")
+        resp_json = resp.json()
         if resp.status_code == 200: 
-            if 'data' in resp.json().keys():
-                if (resp.json()['data']['base'] == symbol.split('/')[0]) & (resp.json()['data']['currency'] == symbol.split('/')[1]):
-                    return {symbol: resp.json()['data']['amount']}
+            if 'data' in resp_json.keys():
+                if (resp_json['data']['base'] == symbol.split('/')[0]) & (resp_json['data']['currency'] == symbol.split('/')[1]):
+                    return {symbol: resp_json['data']['amount']}
         else: 
             print(f"bad response for {symbol}: {resp.status_code} from API")
-            if 'errors' in resp.json().keys():
-                for err in resp.json()['errors']:
+            if 'errors' in resp_json.keys():
+                for err in resp_json['errors']:
+                    print(err)
+
+    def getExchangeRates(self, native='USD'):
+        """
+        Get the exchange rates of every asset against the native currency in one API call
+
+        Args:
+            native (str, optional): currency the rates are quoted against. Defaults to 'USD'.
+
+        Returns:
+            dict: {asset: units of the asset per 1 native} from the API
+        """
+        resp = self.request(f"/exchange-rates?currency={native}")
+        resp_json = resp.json()
+        if resp.status_code == 200: 
+            if 'data' in resp_json.keys():
+                return resp_json['data']['rates']
+        else: 
+            print(f"bad response for exchange rates ({native}): {resp.status_code} from API")
+            if 'errors' in resp_json.keys():
+                for err in resp_json['errors']:
                     print(err)
 
-    def getSpotPrices(self, symbols):
+    def getSpotPrices(self, symbols, bulk=True):
         """
-        Get the current prices for the symbols provided
+        Get the current prices for the symbols provided.
+        In bulk mode all prices for a native currency come from one exchange rates call, 
+        any symbols not covered are pulled individually (concurrently)
 
         Args:
             symbol ([str]): trading symbol as XXX/XXX
+            bulk (bool, optional): use the exchange rates API to price every symbol for a native currency in one call. Defaults to True.
 
         Returns:
             dict: response from the API
         """
         sp = {}
-        for symbol in symbols:
-            spot = self.getSpotPrice(symbol)
+        remaining = list(symbols)
+        if bulk:
+            for native in set([symbol.split('/')[1] for symbol in symbols]):
+                rates = self.getExchangeRates(native)
+                if rates is None:
+                    continue
+                for symbol in [symbol for symbol in symbols if symbol.split('/')[1] == native]:
+                    rate = rates.get(symbol.split('/')[0])
+                    if (rate is not None) and (float(rate) != 0):
+                        sp[symbol] = 1/float(rate)
+                        remaining.remove(symbol)
+
+        for spot in self.executor.map(run_in_context(self.getSpotPrice), remaining):
             if spot is not None: sp.update(spot)
         return sp
 
-    def getHistoricalPrices(self, symbol):
+    def getHistoricalPrices(self, symbol, since=None):
         """
         Get the recent Historical prices for the provided symbol within the exchange via API call
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
 
         Returns:
             dict: response from the API
         """
-        resp = self.pro_request(f"/products/{symbol.replace('/','-')}/candles?granularity=86400")
+        uri_path = f"/products/{symbol.replace('/','-')}/candles?granularity=86400"
+        # the API returns at most 300 candles - a start/end range is only requested when it fits within that
+        if (since is not None) and ((pd.Timestamp.utcnow().tz_convert(None) - pd.Timestamp(since)).days < 300):
+            uri_path += f"&start={pd.Timestamp(since).isoformat()}&end={pd.Timestamp.utcnow().tz_convert(None).isoformat()}"
+        resp = self.pro_request(uri_path)
         if resp.status_code == 200: 
             if len(resp.json())>0:
                 return resp.json()
@@ -218,35 +289,37 @@ class Coinbase(Exchange):
             print(f"bad response: {resp.status_code} from API")
             print(resp.json())
     
-    def getHistoricalPricesDataFrame(self,symbol):
+    def getHistoricalPricesDataFrame(self, symbol, since=None):
         """
         Get the recent Historical prices for the provided symbol within the exchange via API call
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
 
         Returns:
             pandas.DataFrame: response from the API
         """
-        historicalPrices = self.getHistoricalPrices(symbol)        
+        historicalPrices = self.getHistoricalPrices(symbol, since)        
         if historicalPrices is not None:
             df = pd.DataFrame(historicalPrices, columns=['unix', 'low', 'high', 'open', 'close', 'volume'])
             df['date'] = pd.to_datetime(df['unix'], unit='s')  
             df['volume_from'] = df['volume'].astype(float) * df['close'].astype(float)     
             return df
     
-    def getHistoricalPricesDataFrame_Universal(self,symbol):
+    def getHistoricalPricesDataFrame_Universal(self, symbol, since=None):
         """
         Get the recent Historical prices for the provided symbol within the exchange via API call
         UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
 
         Returns:
             pandas.DataFrame: response from the API
         """
-        df = self.getHistoricalPricesDataFrame(symbol)
+        df = self.getHistoricalPricesDataFrame(symbol, since)
         if df is not None:
             if df.empty == False:
                 df[symbol] = (df['high'].astype(float)+df['low'].astype(float))/2  
@@ -368,49 +441,104 @@ class Coinbase(Exchange):
 
         return df
     
+    def iterWalletTransactions(self, account, ending_before=None):
+        """
+        pulls the transactions associated with the API wallet account on the exchange, page by page (newest first)
+
+        Args:
+            account (str): account id (from the accounts API call)
+            ending_before (str, optional): transaction id - only transactions newer than this one are pulled. Defaults to None.
+
+        Yields:
+            pandas.DataFrame: formatted dataframe of each page of transactions
+        """
+        uri_path = f'/accounts/{account}/transactions?limit={coinbase_page_limit}&order=desc'
+        if ending_before is not None:
+            uri_path += f'&ending_before={ending_before}'
+        for page in self.iterPages(uri_path):
+            yield self.parse_api_results(page)
+
     def getWalletTransactions(self, account):
         """
-        pulls the transactions associated with the API wallet account on the exchange into a dataframe
+        pulls the transactions associated with the API wallet account on the exchange
 
         Args:
             account (str): account id (from the accounts API call)
 
         Returns:
-            dict: response from the API
+            dict: response from the API, with the data from every page
         """        
-        resp = self.auth_request(f'/accounts/{account}/transactions', {'limit' : '100','order' : 'desc'})
-        if resp.status_code == 200: 
-            if 'data' in resp.json().keys():
-                return resp.json()
-            elif 'error' in resp.json().keys():
-                for err in resp.json()['error']:
-                    print(f"error: {err}")
-            else: print(f"no results in API response")
-        else: 
-            print(f"bad response: {resp.status_code} from API")
-            return None    
+        try:
+            pages = list(self.iterPages(f'/accounts/{account}/transactions?limit={coinbase_page_limit}&order=desc'))
+        except IncompletePages as err:
+            print(err)
+            return None
+        if len(pages)>0:
+            return {'data' : [transaction for page in pages for transaction in page['data']]}
+
+    def getAccountTransactions(self, account, ending_before=None):
+        """
+        pulls the transactions associated with the API wallet account on the exchange into a dataframe
+
+        Args:
+            account (dict): account (from the accounts API call)
+            ending_before (str, optional): transaction id - only transactions newer than this one are pulled. Defaults to None.
+
+        Raises:
+            IncompletePages: a page of transactions could not be retrieved
+
+        Returns:
+            pandas.DataFrame: formatted dataframe of the transactions in the account (newest first)
+        """
+        print(f"pulling transactions for {account['name']}")
+        pages = list(self.iterWalletTransactions(account['id'], ending_before))
+        if len(pages)>0:
+            return pd.concat(pages, axis = 0, sort=False)
+        return pd.DataFrame()
                       
-    def getTransactions(self,refresh=False):
+    def getTransactions(self,refresh=False,resync=False):
         """
-        pulls the transactions associated with all accounts within the API wallet account on the exchange into a dataframe
+        pulls the transactions associated with all accounts within the API wallet account on the exchange into a dataframe.
+        Accounts are pulled concurrently and synced incrementally - per account, only transactions newer than the newest stored one are requested
 
         Args:
             refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+            resync (bool, optional): ignore the stored transactions and download the full history. Defaults to False.
 
         Returns:
             pandas.DataFrame: response from the API, loaded into the self.transactions variable
         """   
         if (refresh == True) or ('transactions' not in vars(self)):
-            df=pd.DataFrame()
             accounts = self.getAccounts(refresh)
             if accounts is not None:
                 if 'data' in accounts.keys():
-                    for acc in accounts['data']:
-                        print(f"pulling transactions for {acc['name']}")
-                        if acc['currency'] not in fiat_currencies:   
-                            resp = self.getWalletTransactions(acc['id'])
-                            tmp_df = self.parse_api_results(resp)
-                            df = pd.concat([df, tmp_df], axis = 0, sort=False)
+                    state = {} if resync else self.loadSyncState('transactions')
+                    cursors = state.get('cursor', {})
+                    crypto_accounts = [acc for acc in accounts['data'] if acc['currency'] not in fiat_currencies]
+
+                    def sync_account(acc):
+                        try:
+                            return self.getAccountTransactions(acc, cursors.get(acc['id']))
+                        except IncompletePages as err:
+                            # the missing pages are older than the newest transaction received - keep the account's stored transactions and cursor
+                            print(f"transactions for {acc['name']} incomplete ({err}) - keeping the stored transactions and cursor")
+                            return None
+
+                    with ThreadPoolExecutor(max_workers=coinbase_account_workers) as executor:
+                        synced = [(acc, account_df) for acc, account_df in zip(crypto_accounts, executor.map(run_in_context(sync_account), crypto_accounts))
+                            if account_df is not None
+                        ]
+
+                    for acc, account_df in synced:
+                        if account_df.empty == False:
+                            cursors[acc['id']] = account_df.index[0]
+                    account_dfs = [account_df for _, account_df in synced]
+
+                    # upsert the new transactions into the stored history by transaction id
+                    df = pd.concat([pd.DataFrame()]+account_dfs+[state.get('history', pd.DataFrame())], axis = 0, sort=False)
+                    df = df[~df.index.duplicated(keep='first')]
+                    if df.empty == False:
+                        self.saveSyncState('transactions', {'history': df, 'cursor': cursors})
                     self.transactions = df
                     return self.transactions
         else: return self.transactions
\ No newline at end of file
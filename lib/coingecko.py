@@ -1,8 +1,12 @@
 import pandas as pd
 
+from lib.functions import load_data_file, save_data_file
 from lib.exchange import Exchange
 
 class CoinGecko(Exchange):
+    # symbol -> id indexes per version (fetch time) of the coin list, shared by every instance
+    symbol_indexes = {}
+
     def __init__(self):
         self.api_url = 'https://api.coingecko.com/api/v3'
     
@@ -17,30 +21,64 @@ class CoinGecko(Exchange):
             pandas.DataFrame(): response from the API, loaded into the self.coinList variable
         """
         if (refresh == True) or ('coinList' not in vars(self)):
-            resp = self.request('/coins/list?')
+            resp = self.reference_request(f'{self.api_url}/coins/list', refresh=refresh)
             if resp.status_code == 200: 
                 if len(resp.json())>0:
                     self.coinList = pd.DataFrame(resp.json()).set_index('id')
+                    self.symbolIndex = self.getSymbolIndex(resp.json(), resp.fetched)
                     return self.coinList
             else: print(f"bad response: {resp.status_code} from API")
         else: return self.coinList
+
+    def getSymbolIndex(self, coins, fetched):
+        """
+        Get the lookup index for the coin list - built once per version of the coin list and stored alongside the cached list.
+        Candidate ids for a symbol are ranked: ids matching the coin name first (e.g. 'ethereum' for ETH), then shorter ids
+
+        Args:
+            coins (list): coin list from the API - dictionaries with 'id', 'symbol' and 'name'
+            fetched (float): time the coin list was fetched, identifies the version of the list
+
+        Returns:
+            dict: {'symbols': {upper-cased symbol: [ranked ids]}, 'ids': {id: symbol}}
+        """
+        if fetched in self.symbol_indexes.keys():
+            return self.symbol_indexes[fetched]
+
+        index_file = ('http_cache', 'coingecko_symbol_index.pkl')
+        index = load_data_file(*index_file)
+        if (index is None) or (index['fetched'] != fetched):
+            candidates = {}
+            for position, coin in enumerate(coins):
+                rank = (coin['id'] != str(coin.get('name','')).lower().replace(' ','-'), len(coin['id']), position)
+                candidates.setdefault(coin['symbol'].upper(), []).append((rank, coin['id']))
+            index = {
+                'fetched': fetched,
+                'symbols': {symbol: [coin_id for rank, coin_id in sorted(ids)] for symbol, ids in candidates.items()},
+                'ids': {coin['id']: coin['symbol'] for coin in coins}
+            }
+            save_data_file(index, *index_file)
+
+        self.symbol_indexes.clear()
+        self.symbol_indexes[fetched] = index
+        return index
     
     def getSymbolID(self, symbol, refresh=False):
         """
-        Get the ID for the symbol within the exchange
+        Get the ID for the symbol within the exchange (the best ranked candidate where several coins share a symbol)
 
         Args:
             symbol (str): symbol to retrieve the coingecko specific asset ID for
             refresh (bool, optional): re-call the API function if the variables used have not already been declared. Defaults to False.
 
         Returns:
-            pandas.DataFrame(): response from the API
+            str: coingecko asset ID
         """
         coinList = self.getCoinList(refresh)
         if coinList is not None: 
-            df = coinList[coinList.symbol == symbol.lower()]
-            if df.empty==False:
-                return df.index.values[0]  
+            ids = self.symbolIndex['symbols'].get(symbol.upper(), [])
+            if len(ids)>0:
+                return ids[0]
             
     def getSymbolIDs(self, symbols, refresh=False):
         """
@@ -51,13 +89,16 @@ class CoinGecko(Exchange):
             refresh (bool, optional): re-call the API function if the variables used have not already been declared. Defaults to False.
 
         Returns:
-            pandas.DataFrame(): response from the API
+            pandas.DataFrame(): every candidate id (ranked) for each symbol - indexed by symbol
         """
         coinList = self.getCoinList(refresh)
         if coinList is not None: 
-            df = coinList[coinList.symbol.str.upper().isin(symbols)]
-            if df.empty==False:
-                return df.reset_index().set_index('symbol')[['id']]     
+            rows = [(self.symbolIndex['ids'][coin_id], coin_id) 
+                for symbol in symbols 
+                    for coin_id in self.symbolIndex['symbols'].get(symbol.upper(), [])
+            ]
+            if len(rows)>0:
+                return pd.DataFrame(rows, columns=['symbol','id']).set_index('symbol')
     
     def getSymbolPrice(self, symbol, native='USD', refresh=False):
         """
@@ -80,7 +121,7 @@ class CoinGecko(Exchange):
     
     def getSymbolPrices(self, symbols, native='USD', refresh=False):
         """
-        Get the spot prices for the symbols within the exchange
+        Get the spot prices for the symbols within the exchange (priced by the best ranked id for each symbol)
 
         Args:
             symbols (str): symbol to retrieve the coingecko specific asset ID for
@@ -90,15 +131,20 @@ class CoinGecko(Exchange):
         Returns:
             dict: price from API
         """
-        symbolIDs = self.getSymbolIDs(symbols,refresh)
-        if symbolIDs is not None:
-            coinList = self.getCoinList(refresh)
-            symbols_str = ','.join(symbolIDs.id.drop_duplicates())
+        # the coin list is loaded (or revalidated) once, then every symbol is resolved from the index
+        coinList = self.getCoinList(refresh)
+        if coinList is None:
+            return None
+        symbolIDs = [ids[0] for ids in [self.symbolIndex['symbols'].get(symbol.upper(), []) for symbol in symbols] if len(ids)>0]
+        if len(symbolIDs)>0:
+            symbols_str = ','.join(list(dict.fromkeys(symbolIDs)))
             resp = self.request(f'/simple/price?ids={symbols_str}&vs_currencies={native.lower()}')
             if resp.status_code == 200: 
                 prices = {}
-                for symbolID in resp.json():
-                    prices[f"{coinList.at[symbolID,'symbol']}/{native}".upper()] = resp.json()[symbolID][native.lower()]
+                resp_json = resp.json()
+                for symbolID in resp_json:
+                    if native.lower() in resp_json[symbolID].keys():
+                        prices[f"{self.symbolIndex['ids'][symbolID]}/{native}".upper()] = resp_json[symbolID][native.lower()]
                 return prices
             else: print(f"bad response: {resp.status_code} from API")
             
@@ -2,8 +2,8 @@ import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
 
-from lib.functions import mask_str, decrypt, add_columns_by_index
-from config import stable_coin_alts, fiat_currencies
+from lib.functions import get_masked_label, add_columns_by_index
+from config import stable_coin_alts, fiat_currencies, coinexplorer_assets
 
 def generate_individual_wallet_listgroup(wallets,wallet_type,key=''):
     """
@@ -23,7 +23,6 @@ def generate_individual_wallet_listgroup(wallets,wallet_type,key=''):
     Returns:
         list: list of html listgroups of the sub addresses provided 
     """
-    wallet_name_dct = {'APIs' : 'api_key', 'Addresses' : 'address' }
     ls=[]
     for wallet in wallets: 
         if key == '':
@@ -33,7 +32,7 @@ def generate_individual_wallet_listgroup(wallets,wallet_type,key=''):
             ]
         else:
             wallet_str = [
-                html.Span(f"{mask_str(decrypt(wallet[wallet_name_dct[wallet_type]].encode(), key).decode())}", style={'color':'CornflowerBlue'}),
+                html.Span(f"{get_masked_label(wallet, wallet_type, key)}", style={'color':'CornflowerBlue'}),
                 html.Span(f" added {wallet['time_added']}", style={'font-size':'smaller'} ) 
             ]
         ls+=[   
@@ -182,14 +181,13 @@ def generate_wallet_cards(wallet_dict, key=''):
         multi=False,
         value='Kraken'
     )
-    # asset selection for wallet addresses - hardcoded options for now
+    # asset selection for wallet addresses - coinexplorer assets come from config
     asset_dropdown = dcc.Dropdown(
         id = 'asset-dd',
         options=[
             {'label': 'Bitcoin', 'value': 'BTC'},
             {'label': 'Ethereum', 'value': 'ETH'},
-            {'label': 'Vertcoin', 'value': 'VTC'}
-        ],
+        ] + [{'label': coinexplorer_assets[asset], 'value': asset} for asset in coinexplorer_assets],
         multi=False,
         value='BTC'
     )
@@ -335,4 +333,30 @@ def generate_balance_table(balance_df, prices_df, native_asset='USD', group_addr
         [   html.Thead(html.Tr([html.Th('')]+[html.Th(col) for col in display_cols])),
             html.Tbody(wallet_str)
         ], striped=True, bordered=False, hover=True, style={'text-align':'left'}
-    )
\ No newline at end of file
+    )
+
+def generate_refresh_report(report):
+    """
+    generates alerts listing the sources the last balance refresh could not use, shown above the balance table
+
+    Args:
+        report (dict): refresh report from the refresh worker:
+        -   'stale': {source: time retrieved} for sources shown from their last known good balances
+        -   'failed': {source: reason} for sources without any balances
+        -   'missed_deadline': [sources] which missed the refresh deadline
+
+    Returns:
+        list: list of html alerts (empty if every source was used)
+    """
+    from datetime import datetime
+    alerts = []
+    if report is None:
+        return alerts
+    if len(report.get('stale', {}))>0:
+        stale = [f"{source} (as of {datetime.fromtimestamp(retrieved).strftime('%d/%m/%Y %H:%M:%S')})" for source, retrieved in report['stale'].items()]
+        alerts += [dbc.Alert(f"Showing last known balances for: {', '.join(stale)}", color='warning')]
+    if len(report.get('failed', {}))>0:
+        alerts += [dbc.Alert(f"Could not retrieve balances for: {', '.join(report['failed'].keys())}", color='danger')]
+    if len(report.get('missed_deadline', []))>0:
+        alerts += [dbc.Alert(f"Missed the refresh deadline (left out): {', '.join(report['missed_deadline'])}", color='warning')]
+    return alerts
\ No newline at end of file
@@ -0,0 +1,86 @@
+import contextvars
+import time
+
+# Deadline of the refresh the current code is running for - propagated to worker threads with run_in_context
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a call is started (or would have to wait) after the refresh deadline has passed
+    """
+
+class Deadline():
+    def __init__(self, seconds):
+        """
+        Refresh-wide deadline. Within a `with Deadline(seconds):` block every API call is limited to the time remaining,
+        and calls started after the deadline raise DeadlineExceeded
+
+        Args:
+            seconds (float): seconds from now until the deadline
+        """
+        self.expires = time.monotonic() + seconds
+        self.token = None
+
+    def remaining(self):
+        """
+        Returns:
+            float: seconds until the deadline (0 once it has passed)
+        """
+        return max(0, self.expires - time.monotonic())
+
+    def __enter__(self):
+        self.token = current_deadline.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        current_deadline.reset(self.token)
+        return False
+
+def remaining_time():
+    """
+    Seconds left before the current deadline
+
+    Returns:
+        float: seconds until the deadline, None if no deadline is set
+    """
+    deadline = current_deadline.get()
+    if deadline is not None:
+        return deadline.remaining()
+
+def deadline_timeout(timeout):
+    """
+    Limit a request timeout to the time remaining before the current deadline
+
+    Args:
+        timeout (float/tuple): (connect, read) timeout in seconds
+
+    Raises:
+        DeadlineExceeded: the deadline has already passed
+
+    Returns:
+        float/tuple: timeout no longer than the time remaining
+    """
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded("refresh deadline passed")
+    if isinstance(timeout, tuple):
+        return tuple(min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+def run_in_context(function):
+    """
+    Bind a function to the current context (and so the current deadline) - for functions handed to worker threads
+
+    Args:
+        function (callable): function to run in another thread
+
+    Returns:
+        callable: function which runs in a copy of the current context - each call gets its own copy, 
+        so the wrapper can be handed to executor.map and run in several threads at once
+    """
+    context = contextvars.copy_context()
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return run
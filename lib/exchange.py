@@ -1,21 +1,378 @@
+import asyncio
+import functools
+import hashlib
+import pickle
+import threading
+import time
+import urllib.parse
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import InvalidToken
 
-from config import stable_coin_alts
+from config import stable_coin_alts, session_pool_connections, session_pool_maxsize, request_timeout, async_max_workers, reference_cache_ttl, rate_limits, rate_limit_max_retries
+from lib.functions import load_data_file, save_data_file, encrypt, decrypt
+from lib.candles import CandleStore
+from lib.rate_limit import TokenBucket
+from lib.deadline import DeadlineExceeded, deadline_timeout, remaining_time, run_in_context
+from lib.circuit_breaker import record_outage
 
-class Exchange():    
-    def request(self, uri_path):
+class IncompletePages(Exception):
+    """
+    Raised when paging through a private history API stops before the last page (bad response or error reply)
+    """
+
+class Exchange():
+    # One pooled keep-alive session per host, shared by every exchange instance and the address APIs
+    sessions = {}
+    sessions_lock = threading.Lock()
+    # Request budget (token bucket) per host, created from rate_limits in config.py on first use
+    buckets = {}
+    buckets_lock = threading.Lock()
+    # Worker threads backing the awaitable (*_async) API - blocking I/O runs here so the event loop can await many calls at once
+    executor = ThreadPoolExecutor(max_workers=async_max_workers, thread_name_prefix='exchange')
+    # Responses of public reference endpoints (asset pairs, products, coin lists etc.) shared by every instance, backed on disk
+    reference_cache = {}
+    reference_cache_lock = threading.Lock()
+    # Local daily price store shared by every exchange, opened on first use
+    candle_store = None
+    candle_store_lock = threading.Lock()
+
+    @classmethod
+    def get_session(cls, url):
+        """
+        Get the shared session for the host of the provided url, creating it (with a connection pool) on first use
+
+        Args:
+            url (str): full url of the API request
+
+        Returns:
+            requests.Session: keep-alive session mounted with a pooled adapter for the url's host
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with cls.sessions_lock:
+            if host not in cls.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=session_pool_connections, pool_maxsize=session_pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'Connection': 'keep-alive'})
+                cls.sessions[host] = session
+            return cls.sessions[host]
+
+    @classmethod
+    def close_sessions(cls):
+        """
+        Close every pooled session (and their connections)
+        """
+        with cls.sessions_lock:
+            for session in cls.sessions.values():
+                session.close()
+            cls.sessions = {}
+
+    @classmethod
+    def get_bucket(cls, url):
+        """
+        Get the request budget (token bucket) for the host of the provided url
+
+        Args:
+            url (str): full url of the API request
+
+        Returns:
+            TokenBucket: rate limiter for the url's host
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with cls.buckets_lock:
+            if host not in cls.buckets:
+                rate, capacity = rate_limits.get(host, rate_limits['default'])
+                cls.buckets[host] = TokenBucket(rate, capacity)
+            return cls.buckets[host]
+
+    @classmethod
+    def http_request(cls, method, url, timeout=None, priority=0, **kwargs):
+        """
+        Submit a request through the pooled session for the url's host, within the host's request budget.
+        Throttled requests (429 responses, or responses is_throttled recognises e.g. Kraken's rate limit errors) back the host's rate off 
+        and are retried after any Retry-After the host asked for - private APIs sign through auth= (requests.auth.AuthBase), which signs every attempt afresh.
+        Within a refresh Deadline the timeout is cut to the time remaining, and DeadlineExceeded is raised once it has passed.
+        Transport errors, timeouts, 5xx and still-throttled responses are recorded as outages for the circuit breaker of the calling source
+
+        Args:
+            method (str): method of the API request e.g. GET, POST etc.
+            url (str): full url of the API request
+            timeout (float/tuple, optional): (connect, read) timeout in seconds. Defaults to request_timeout from config.py.
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
+            **kwargs: passed through to requests.Session.request (headers, data, auth etc.)
+
+        Returns:
+            response: response from the requests package (API)
+        """
+        if timeout is None:
+            timeout = request_timeout
+        bucket = cls.get_bucket(url)
+        for attempt in range(rate_limit_max_retries+1):
+            if bucket.acquire(priority, remaining_time()) == False:
+                raise DeadlineExceeded(f"refresh deadline passed waiting to call {urllib.parse.urlsplit(url).netloc}")
+            try:
+                resp = cls.get_session(url).request(method, url, timeout=deadline_timeout(timeout), **kwargs)
+            except requests.exceptions.RequestException as err:
+                record_outage(f"{err!r} calling {urllib.parse.urlsplit(url).netloc}")
+                raise
+            if (resp.status_code != 429) and (cls.is_throttled(resp) == False):
+                if resp.status_code >= 500:
+                    record_outage(f"{resp.status_code} from {urllib.parse.urlsplit(url).netloc}")
+                bucket.success()
+                return resp
+            retry_after = resp.headers.get('Retry-After')
+            print(f"rate limited by {urllib.parse.urlsplit(url).netloc} (attempt {attempt+1}), retry after: {retry_after}")
+            bucket.backoff(float(retry_after) if (retry_after is not None) and retry_after.isdigit() else None)
+        record_outage(f"still rate limited by {urllib.parse.urlsplit(url).netloc}")
+        return resp
+
+    @classmethod
+    def is_throttled(cls, resp):
+        """
+        Whether a non-429 response is the host telling us to slow down - for exchanges which report throttling in the response body
+
+        Args:
+            resp (response): response from the requests package
+
+        Returns:
+            bool: True if the request was throttled
+        """
+        return False
+
+    @classmethod
+    def reference_request(cls, url, ttl=None, refresh=False, priority=0):
+        """
+        GET a public reference endpoint through the shared response cache.
+        A cached response younger than the ttl is served without any request, an older one is revalidated with a 
+        conditional request (ETag/Last-Modified) where the server supports it. Cached responses survive restarts (stored in the app data location)
+
+        Args:
+            url (str): full url of the API request
+            ttl (int, optional): seconds a cached response is served without revalidation. Defaults to reference_cache_ttl from config.py.
+            refresh (bool, optional): revalidate the cached response even if it is younger than the ttl. Defaults to False.
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
+
+        Returns:
+            CachedResponse/response: cached response (status_code, json(), fetched) or the response from the requests package if the request failed and nothing is cached
+        """
+        if ttl is None:
+            ttl = reference_cache_ttl
+        cache_file = ('http_cache', f"{hashlib.sha256(url.encode()).hexdigest()}.pkl")
+        with cls.reference_cache_lock:
+            entry = cls.reference_cache.get(url)
+        if entry is None:
+            entry = load_data_file(*cache_file)
+            if entry is not None:
+                # keep the entry loaded from disk in memory, so other instances don't un-pickle it again
+                with cls.reference_cache_lock:
+                    entry = cls.reference_cache.setdefault(url, entry)
+
+        if (entry is not None) and (refresh == False) and ((time.time() - entry['fetched']) < ttl):
+            return CachedResponse(entry)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag') is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
+        resp = cls.http_request('GET', url, priority=priority, headers=headers)
+
+        if (resp.status_code == 304) and (entry is not None):
+            entry = {**entry, 'fetched': time.time()}
+        elif resp.status_code == 200:
+            entry = {
+                'payload': resp.json(), 
+                'etag': resp.headers.get('ETag'), 
+                'last_modified': resp.headers.get('Last-Modified'), 
+                'fetched': time.time()
+            }
+        elif entry is not None:
+            print(f"bad response: {resp.status_code} from {url}, serving cached response")
+            return CachedResponse(entry)
+        else:
+            return resp
+
+        with cls.reference_cache_lock:
+            cls.reference_cache[url] = entry
+        save_data_file(entry, *cache_file)
+        return CachedResponse(entry)
+
+    def request(self, uri_path, priority=0):
         """
         API request to the api_url already within the class (self.api_url)
 
         Args:
             uri_path (str): sub path for the api call
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
 
         Returns:
             response: json response from the requests package (API)
         """
-        return requests.get(f"{self.api_url}{uri_path}")
+        return self.http_request('GET', f"{self.api_url}{uri_path}", priority=priority)
                           
+    def getSyncFile(self, name):
+        """
+        name of the file holding a synced private history for this API wallet (identified by a hash of its stored api key)
+
+        Args:
+            name (str): history being synced e.g. 'trades'
+
+        Returns:
+            tuple: path of the file within the app data location
+        """
+        wallet_id = hashlib.sha256(self.api_key).hexdigest()[:16]
+        return ('sync', f"{type(self).__name__.lower()}_{wallet_id}_{name}.pkl")
+
+    def loadSyncState(self, name):
+        """
+        load a synced private history and its sync cursor for this API wallet (stored encrypted with the wallet's key)
+
+        Args:
+            name (str): history being synced e.g. 'trades'
+
+        Returns:
+            dict: stored sync state, empty if the history has not been synced before (or can't be decrypted with the key)
+        """
+        token = load_data_file(*self.getSyncFile(name))
+        if not isinstance(token, bytes):
+            return {}
+        try:
+            return pickle.loads(decrypt(token, self.key))
+        except InvalidToken:
+            print(f"stored {name} could not be decrypted with the current key - syncing the full history")
+            return {}
+
+    def saveSyncState(self, name, state):
+        """
+        persist a synced private history and its sync cursor for this API wallet - encrypted with the wallet's key, 
+        like the API keys and addresses stored in the settings
+
+        Args:
+            name (str): history being synced e.g. 'trades'
+            state (dict): sync state to store
+        """
+        save_data_file(encrypt(pickle.dumps(state), self.key), *self.getSyncFile(name))
+
+    async def run_async(self, function, *args):
+        """
+        Await a blocking exchange function by running it on the shared exchange executor
+
+        Args:
+            function (callable): blocking function e.g. self.getBalances_Universal
+            *args: arguments passed to the function
+
+        Returns:
+            the return value of the function
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run_in_context(functools.partial(function, *args)))
+
+    async def getBalances_Universal_async(self, refresh=False):
+        """
+        Awaitable getBalances_Universal
+        UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
+
+        Args:
+            refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+
+        Returns:
+            dict: see getBalances_Universal
+        """
+        return await self.run_async(self.getBalances_Universal, refresh)
+
+    async def getValidSymbols_Universal_async(self, refresh=False):
+        """
+        Awaitable getValidSymbols_Universal
+        UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
+
+        Args:
+            refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+
+        Returns:
+            list: see getValidSymbols_Universal
+        """
+        return await self.run_async(self.getValidSymbols_Universal, refresh)
+
+    async def getValidAssets_Universal_async(self, refresh=False):
+        """
+        Awaitable getValidAssets_Universal
+        UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
+
+        Args:
+            refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+
+        Returns:
+            list: see getValidAssets_Universal
+        """
+        return await self.run_async(self.getValidAssets_Universal, refresh)
+
+    async def getHistoricalPricesDataFrame_Universal_async(self, symbol, since=None):
+        """
+        Awaitable getHistoricalPricesDataFrame_Universal
+        UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
+
+        Args:
+            symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
+
+        Returns:
+            pandas.DataFrame: see getHistoricalPricesDataFrame_Universal
+        """
+        return await self.run_async(self.getHistoricalPricesDataFrame_Universal, symbol, since)
+
+    @classmethod
+    def getCandleStore(cls):
+        """
+        Get the local daily price store shared by every exchange
+
+        Returns:
+            CandleStore: store of daily prices per source, symbol and day
+        """
+        with cls.candle_store_lock:
+            if Exchange.candle_store is None:
+                Exchange.candle_store = CandleStore()
+            return Exchange.candle_store
+
+    def getStoredHistoricalPricesDataFrame_Universal(self, symbol):
+        """
+        Get the Historical prices for the provided symbol, using the local price store. 
+        Once the full history is stored only the newest stored day onwards is pulled from the API (past days never change), 
+        until then (nothing stored, or stored before the source could serve older days) the full history is pulled to fill the leading gap
+        UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
+
+        Args:
+            symbol (str): trading symbol as XXX/XXX
+
+        Returns:
+            pandas.DataFrame: dataframe of price daily data in a column named after the symbol - indexed by date
+        """
+        source = type(self).__name__.lower()
+        store_symbol = symbol.replace('-','/')
+        store = self.getCandleStore()
+        stored_df = store.load(source, store_symbol)
+
+        since = None
+        if (stored_df is not None) and store.has_full_history(source, store_symbol):
+            # always re-pull the newest stored day, its candle may have been incomplete when stored
+            since = stored_df.index.max() - pd.Timedelta(days=1)
+
+        df = self.getHistoricalPricesDataFrame_Universal(symbol, since)
+        if (df is None) or (df.empty):
+            return stored_df if stored_df is not None else df
+        store.save(source, store_symbol, df)
+        if since is None:
+            store.mark_full_history(source, store_symbol)
+
+        if stored_df is not None:
+            df = pd.concat([stored_df, df[[store_symbol]]], axis=0)
+            df = df[~df.index.duplicated(keep='last')].sort_index()
+        return df
+
     def getHistoricalPricesDataFrameList_Universal(self,symbols,native='USD',stable_coin_alt=True,stable_coin_alts=stable_coin_alts, hp_df = pd.DataFrame()):
         """
         Retrieve historical price dataframe from the list of provided symbols.
@@ -46,16 +403,65 @@ class Exchange():
                 
             elif temp_symbol not in hp_df.columns:
                 print(f'new pair found! Pulling data for {symbol} ({temp_symbol})')
-                df = self.getHistoricalPricesDataFrame_Universal(temp_symbol)
+                df = self.getStoredHistoricalPricesDataFrame_Universal(temp_symbol)
                 # If activated (stable_coin_alt==True) and the above pull provided None, try pulling each alternative instead
                 for stable_coin in stable_coin_alts[native]:
                     if stable_coin_alt and (df is None):
                         print(f"trying alternative: {symbol.replace(native,stable_coin)}")
-                        df = self.getHistoricalPricesDataFrame_Universal(symbol.replace(native,stable_coin))
+                        df = self.getStoredHistoricalPricesDataFrame_Universal(symbol.replace(native,stable_coin))
                         
                 # e.g. if ETH was pulled for ETH2.S, then we should add both to prevent repulling ETH for ETH2 etc.
                 if (symbol not in hp_df.columns) and (symbol != temp_symbol):
                     df[symbol] = df[temp_symbol].copy()
                     
                 hp_df = pd.concat([hp_df,df], axis = 1, sort=True, join='outer')
-        return hp_df
\ No newline at end of file
+        return hp_df
+
+def gather_async(awaitables):
+    """
+    Run awaitables (e.g. exchange *_async calls) concurrently from synchronous code and wait for all of them (or the current deadline).
+    Total latency is that of the slowest call rather than the sum of every call
+
+    Args:
+        awaitables (list): coroutines to run concurrently
+
+    Returns:
+        list: results in the same order as awaitables - any call which raised is returned as its exception, 
+        any call still running at the deadline as DeadlineExceeded
+    """
+    async def gather():
+        tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+        if len(tasks) == 0:
+            return []
+        done, pending = await asyncio.wait(tasks, timeout=remaining_time())
+        for task in pending:
+            task.cancel()
+        results = []
+        for task in tasks:
+            if task not in done:
+                results += [DeadlineExceeded("refresh deadline passed")]
+            elif task.exception() is not None:
+                results += [task.exception()]
+            else:
+                results += [task.result()]
+        return results
+    return asyncio.run(gather())
+
+class CachedResponse():
+    def __init__(self, entry):
+        """
+        Response served from the reference response cache - mirrors the parts of a requests response used by the exchanges
+
+        Args:
+            entry (dict): cache entry with the json 'payload' and the time it was 'fetched'
+        """
+        self.status_code = 200
+        self.payload = entry['payload']
+        self.fetched = entry['fetched']
+
+    def json(self):
+        """
+        Returns:
+            dict/list: json payload of the response
+        """
+        return self.payload
\ No newline at end of file
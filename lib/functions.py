@@ -1,9 +1,16 @@
-from config import remap_assets, fiat_currencies
+from config import remap_assets, fiat_currencies, coinexplorer_assets, balance_max_workers, balance_default_concurrency, balance_source_concurrency
 
 import os
+import pickle
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
 from cryptography.fernet import Fernet
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from lib.deadline import DeadlineExceeded, remaining_time, run_in_context
 
 def asset_variant(asset):
     """
@@ -310,6 +317,55 @@ def locate_settings():
     app_settings = app_data_loc+os.sep+'app_data.json'
     return app_data_loc, app_settings
 
+def locate_data_file(*sub_path):
+    """
+    find (and create the folder for) a file stored within the app data location
+
+    Args:
+        *sub_path (str): path of the file within the app data location e.g. 'sync', 'kraken.pkl'
+
+    Returns:
+        str: full path of the file
+    """
+    app_data_loc, _ = locate_settings()
+    file = os.path.join(app_data_loc, *sub_path)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    return file
+
+def load_data_file(*sub_path, default=None):
+    """
+    load a pickled object from the app data location
+
+    Args:
+        *sub_path (str): path of the file within the app data location
+        default (optional): returned when the file does not exist or cannot be read. Defaults to None.
+
+    Returns:
+        object: the stored object
+    """
+    file = locate_data_file(*sub_path)
+    if os.path.exists(file):
+        try:
+            with open(file, 'rb') as f:
+                return pickle.load(f)
+        except Exception as err:
+            print(f"could not read {file}: {err}")
+    return default
+
+def save_data_file(obj, *sub_path):
+    """
+    pickle an object into the app data location - written to a temporary file first so readers never see a partial file
+
+    Args:
+        obj (object): object to store
+        *sub_path (str): path of the file within the app data location
+    """
+    file = locate_data_file(*sub_path)
+    tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_file, file)
+
 def settings_default():
     """
     default json data file structure
@@ -429,13 +485,153 @@ def mask_str(str):
     else:
         return f"{str[0:3]}...{str[len(str)-3:]}"
 
-def balances_from_dict(wallet_dict, key=''): 
+masked_labels = {}
+masked_labels_lock = threading.Lock()
+
+def masked_label_entry(wallet, wallet_type, key):
     """
-    Gather Balances from provided wallets into a dataframe
+    cache key and validity check of a wallet's masked label - the label is only reused while the wallet's ciphertext and the key are unchanged
+
+    Args:
+        wallet (dict): wallet containing 'id' and the encrypted 'api_key' (APIs) or 'address' (Addresses)
+        wallet_type (str): Addresses/APIs
+        key (bytes/str): decryption key
+
+    Returns:
+        tuple: (wallet_type, id)
+        str: sha256 digest of the ciphertext and key
+    """
+    wallet_name_dct = {'APIs' : 'api_key', 'Addresses' : 'address' }
+    key = key.encode() if isinstance(key, str) else key
+    check = hashlib.sha256(wallet[wallet_name_dct[wallet_type]].encode() + b':' + key).hexdigest()
+    return (wallet_type, wallet['id']), check
+
+def cache_masked_label(wallet, wallet_type, key, value):
+    """
+    store the masked label of a wallet from its plain text value (e.g. when the wallet is added) so it never has to be decrypted for display
+
+    Args:
+        wallet (dict): wallet containing 'id' and the encrypted 'api_key' (APIs) or 'address' (Addresses)
+        wallet_type (str): Addresses/APIs
+        key (bytes/str): key the wallet was encrypted with
+        value (str): plain text api key or address
+
+    Returns:
+        str: masked label
+    """
+    label_key, check = masked_label_entry(wallet, wallet_type, key)
+    label = mask_str(value)
+    with masked_labels_lock:
+        masked_labels[label_key] = {'check': check, 'label': label}
+    return label
+
+def get_masked_label(wallet, wallet_type, key):
+    """
+    masked display label of a wallet's api key/address - decrypted once, then served from the masked_labels cache (keyed by wallet type & id)
+
+    Args:
+        wallet (dict): wallet containing 'id' and the encrypted 'api_key' (APIs) or 'address' (Addresses)
+        wallet_type (str): Addresses/APIs
+        key (bytes/str): decryption key
+
+    Returns:
+        str: masked label
+    """
+    label_key, check = masked_label_entry(wallet, wallet_type, key)
+    with masked_labels_lock:
+        entry = masked_labels.get(label_key)
+    if (entry is not None) and (entry['check'] == check):
+        return entry['label']
+    wallet_name_dct = {'APIs' : 'api_key', 'Addresses' : 'address' }
+    return cache_masked_label(wallet, wallet_type, key, decrypt(wallet[wallet_name_dct[wallet_type]].encode(), key).decode())
+
+def wallet_column_name(wallet_subtype, position, wallet_count):
+    """
+    name of the balance column for a wallet - suffixed with its position when the wallet subtype holds more than one wallet
+
+    Args:
+        wallet_subtype (str): API Exchange/Asset Type e.g. Kraken or BTC
+        position (int): position of the wallet within the wallet subtype
+        wallet_count (int): number of wallets listed under the wallet subtype
+
+    Returns:
+        str: column name e.g. Kraken or BTC_0
+    """
+    if wallet_count>1:
+        return f"{wallet_subtype}_{position}"
+    return wallet_subtype
+
+def api_wallet_balances(exchange_class, wallet, key, column):
+    """
+    Gather the balances for one exchange API wallet
+
+    Args:
+        exchange_class (Exchange): exchange class to use for the wallet e.g. Kraken
+        wallet (dict): wallet information containing the encrypted 'api_key' and 'api_sec'
+        key (str): decryption key
+        column (str): name of the balance column for this wallet
+
+    Returns:
+        dict: {column: {asset: balance}} or None if the exchange did not return balances
+    """
+    exchange = exchange_class(wallet['api_key'].encode(), wallet['api_sec'].encode(), key)
+    balances = exchange.getBalances_Universal()
+    if balances is None:
+        return None
+    valid_assets = exchange.getValidAssets_Universal()
+    column_balances = {}
+    for bal in balances:
+        asset = rename_asset(bal, valid_assets)
+        column_balances[asset] = column_balances.get(asset, 0) + float(balances[bal])
+    return {column: column_balances}
+
+def address_wallet_balances(balance_function, wallet_subtype, wallets, key):
+    """
+    Gather the balances for all addresses listed under an asset
+
+    Args:
+        balance_function (function): address API function for the asset e.g. blockchain_address_api
+        wallet_subtype (str): Asset Type e.g. BTC
+        wallets (list): list of wallets containing the encrypted 'address'
+        key (str): decryption key
+
+    Returns:
+        dict: {column: {asset: balance}} with a column per address, or None if the API did not return balances
+    """
+    address_ls = [decrypt(wallet['address'].encode(),key).decode() for wallet in wallets]
+    if wallet_subtype in coinexplorer_assets.keys():
+        balances = balance_function(wallet_subtype,address_ls)
+    else:
+        balances = balance_function(address_ls)
+    if balances is None:
+        return None
+
+    columns = {}
+    for position, address in enumerate(balances):
+        balance = balances[address]['final_balance']
+        if wallet_subtype=='BTC':
+            balance = balance/100000000
+        column_balances = {wallet_subtype: float(balance)}
+        # token holdings of the address (e.g. ERC-20 tokens on ETH addresses) become extra asset rows
+        for token, token_balance in balances[address].get('tokens', {}).items():
+            column_balances[token] = column_balances.get(token, 0) + float(token_balance)
+        columns[wallet_column_name(wallet_subtype, position, len(wallets))] = column_balances
+    return columns
+
+def balances_from_dict(wallet_dict, key='', report=None): 
+    """
+    Gather Balances from provided wallets into a dataframe.
+    Wallets are collected in parallel on a pool per source (sized by balance_source_concurrency from config.py, with at most balance_max_workers calls in flight overall).
+    Each source is called through its circuit breaker - a wallet whose source fails (or is being skipped) is served from its last known good balances, 
+    a wallet without any balances is reported and left out rather than failing the whole collection
 
     Args:
         wallet_dict (dict): dictionary of {wallet_type: {wallet_subtype:[list of wallets]}}
         key (str, optional): decryption key
+        report (dict, optional): if provided, filled with:
+        -   'failed': {source: reason} for every wallet source which returned no balances
+        -   'stale': {source: time retrieved} for every wallet source served from its last known good balances
+        -   'missed_deadline': [sources] still running when the refresh Deadline passed (left out)
 
     Returns:
         pandas.DataFrame: DataFrame with indexed assets and a column for each source with the corresponding balances as values
@@ -444,60 +640,76 @@ def balances_from_dict(wallet_dict, key=''):
     from lib.coinbase import Coinbase  
     from lib.bittrex import Bittrex
     from lib.API_functions import blockchain_address_api, infura_eth_address, coinexplorer_addresses_api
-    balance_functions = {'kraken':Kraken,'coinbase':Coinbase,'bittrex':Bittrex,'BTC':blockchain_address_api,'ETH':infura_eth_address, 'VTC':coinexplorer_addresses_api}
-    api_df = pd.DataFrame()
-    address_df = pd.DataFrame()
-    full_df = pd.DataFrame()
-    i={}
-    for wallet_type in wallet_dict:
-        for wallet_subtype in wallet_dict[wallet_type]:
-            i[wallet_subtype]=0     
-            if (wallet_subtype.lower() in balance_functions.keys()) and (wallet_type =='APIs'):
-                for wallet in wallet_dict[wallet_type][wallet_subtype]:                    
+    from lib.circuit_breaker import call_with_breaker
+    balance_functions = {'kraken':Kraken,'coinbase':Coinbase,'bittrex':Bittrex,'BTC':blockchain_address_api,'ETH':infura_eth_address}
+    balance_functions.update({asset: coinexplorer_addresses_api for asset in coinexplorer_assets})
+    if report is None:
+        report = {}
+    report['failed'] = {}
+    report['stale'] = {}
+    report['missed_deadline'] = []
+
+    # each source gets its own pool (sized by its concurrency limit), so wallets queued for one busy source never hold up the others;
+    # the shared semaphore keeps the total number of calls in flight within balance_max_workers
+    all_sources_limit = threading.BoundedSemaphore(balance_max_workers)
+    def limited(source, cache_key, function, *args):
+        with all_sources_limit:
+            return call_with_breaker(source, cache_key, function, *args)
+
+    executors = {}
+    def submit(source, *args):
+        if source not in executors:
+            executors[source] = ThreadPoolExecutor(
+                max_workers=balance_source_concurrency.get(source, balance_default_concurrency), thread_name_prefix=f'balances-{source}'
+            )
+        return executors[source].submit(run_in_context(limited), source, *args)
+
+    jobs = []
+    try:
+        for wallet_type in wallet_dict:
+            for wallet_subtype in wallet_dict[wallet_type]:
+                wallets = wallet_dict[wallet_type][wallet_subtype]
+                if (wallet_subtype.lower() in balance_functions.keys()) and (wallet_type =='APIs'):
                     exchange_class = balance_functions[wallet_subtype.lower()]
-                    
-                    exchange = exchange_class(wallet['api_key'].encode(), wallet['api_sec'].encode(), key)
-                    balances = exchange.getBalances_Universal()
-                    df = pd.DataFrame()
-
-                    for bal in balances:
-                        if len(wallet_dict[wallet_type][wallet_subtype])>1:
-                            index_str = f"{wallet_subtype}_{i[wallet_subtype]}"
-                        else:
-                            index_str = wallet_subtype
-                        tmp_df = pd.DataFrame({index_str : balances[bal]},index=[rename_asset(bal,exchange.getValidAssets_Universal())])
-                        df = pd.concat([df,tmp_df], axis=0, sort=True)
-                    api_df = pd.concat([api_df,df], axis=1, sort=True)
-                    i[wallet_subtype]+=1
-
-
-            elif (wallet_subtype.upper() in balance_functions.keys()) and (wallet_type !='APIs'):
-                address_ls = [decrypt(i['address'].encode(),key).decode() for i in wallet_dict[wallet_type][wallet_subtype]]
-                    
-                balance_function = balance_functions[wallet_subtype]
-                if wallet_subtype == 'VTC':
-                    balances = balance_function(wallet_subtype,address_ls)
-                else:
-                    balances = balance_function(address_ls)
-                if balances is not None:
-                    for address in balances:
-                        if len(wallet_dict[wallet_type][wallet_subtype])>1:
-                            index_str = f"{wallet_subtype}_{i[wallet_subtype]}"
-                        else:
-                            index_str = wallet_subtype
-
-                        balance = balances[address]['final_balance']
-                        if wallet_subtype=='BTC':
-                            balance = balance/100000000
-                        tmp_df = pd.DataFrame({index_str : balance },index=[wallet_subtype])
-                        address_df = pd.concat([address_df,tmp_df], axis=1, sort=True)
-                        i[wallet_subtype]+=1
-
-            full_df = pd.concat([api_df,address_df], axis=1, sort=True)
+                    for position, wallet in enumerate(wallets):
+                        column = wallet_column_name(wallet_subtype, position, len(wallets))
+                        jobs += [(column, submit(wallet_subtype.lower(), wallet['api_key'], api_wallet_balances, exchange_class, wallet, key, column))]
+
+                elif (wallet_subtype.upper() in balance_functions.keys()) and (wallet_type !='APIs'):
+                    balance_function = balance_functions[wallet_subtype]
+                    cache_key = '|'.join([wallet['address'] for wallet in wallets])
+                    jobs += [(wallet_subtype, submit(wallet_subtype.lower(), cache_key, address_wallet_balances, balance_function, wallet_subtype, wallets, key))]
+
+        # Assemble all columns once, in wallet order, instead of concatenating as each balance arrives
+        columns = {}
+        for source, job in jobs:
+            try:
+                result, stale_since = job.result(timeout=remaining_time())
+            except FutureTimeoutError:
+                report['missed_deadline'] += [source]
+                print(f"balances for {source} missed the refresh deadline")
+                continue
+            except Exception as err:
+                result, stale_since = None, None
+                report['failed'][source] = repr(err)
+            if result is None:
+                report['failed'].setdefault(source, 'no balances returned')
+                print(f"could not retrieve balances for {source}: {report['failed'][source]}")
+            else:
+                if stale_since is not None:
+                    report['stale'][source] = stale_since
+                    print(f"serving last known balances for {source} (stale since {datetime.fromtimestamp(stale_since)})")
+                columns.update(result)
+    finally:
+        # don't wait for sources which missed the deadline - their remaining calls fail fast once the deadline has passed
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    full_df = pd.DataFrame(columns).sort_index()
     full_df = add_columns_by_index(full_df.copy().fillna(0))
     return full_df
 
-def pull_spot_prices_from_all_sources(symbols, wallet_dict, native='USD', spot_df=pd.DataFrame()):
+def pull_spot_prices_from_all_sources(symbols, wallet_dict, native='USD', spot_df=pd.DataFrame(), report=None):
     """
     use all exchanges to pull prices for the symbols provided
 
@@ -506,6 +718,7 @@ def pull_spot_prices_from_all_sources(symbols, wallet_dict, native='USD', spot_d
         wallet_dict (dict): dictionary of {wallet_type: {wallet_subtype:[list of wallets]}}
         native (str, optional): native currency to use as the right pairing of the spot price. Defaults to 'USD'.
         spot_df (pandas.DataFrame, optional): dataframe which spot prices will be appended to. Defaults to pd.DataFrame().
+        report (dict, optional): if provided, 'missed_deadline' is extended with the price sources which could not be used before the refresh Deadline passed
 
     Returns:
         pandas.DataFrame: updated dataframe with the prices for the symbols appended 
@@ -514,43 +727,86 @@ def pull_spot_prices_from_all_sources(symbols, wallet_dict, native='USD', spot_d
     from lib.bittrex import Bittrex
     from lib.kraken import Kraken
     from lib.coinbase import Coinbase  
-
-    from datetime import datetime
+    from lib.exchange import gather_async
+    from lib.price_feed import price_cache, subscribe_prices
+
+    if report is None:
+        report = {}
+    report.setdefault('missed_deadline', [])
+
+    # prices streamed by the live price feeds are used first - only the rest are polled below
+    streamed_prices = price_cache.get([f'{bal}/{native}' for bal in symbols if f'{bal}/{native}' not in spot_df.columns])
+    if len(streamed_prices)>0:
+        print(f"using streamed prices for {list(streamed_prices.keys())}")
+        spot_df = pd.concat([spot_df,pd.DataFrame(streamed_prices, index=[datetime.now().date()])],axis=1, sort=True, join='outer')
     exchange_classes = {'kraken':Kraken,'coinbase':Coinbase,'bittrex':Bittrex,'coingecko':CoinGecko}
 
-    for wallet_subtype in ['coingecko'] + list(wallet_dict['Wallets']['APIs'].keys()):
-        if wallet_subtype.lower() in ['coingecko','coinbase']:
-            if wallet_subtype.lower() in ['coingecko']:        
-                price_symbols = [bal for bal in symbols if f'{bal}/{native}' not in spot_df.columns]
-                exchange_class = exchange_classes[wallet_subtype.lower()]()
-                spot_price_function = exchange_class.getSymbolPrices
-                valid_symbols = list(set(set(exchange_class.getValidAssets_Universal()) & set(price_symbols)))
-            elif wallet_subtype.lower() in ['coinbase']:                    
-                price_symbols = [f'{bal}/{native}' for bal in symbols if f'{bal}/{native}' not in spot_df.columns]
-                exchange_class = exchange_classes[wallet_subtype.lower()]('', '')
-                spot_price_function = exchange_class.getSpotPrices
-                valid_symbols = list(set(set(exchange_class.getValidSymbols_Universal()) & set(price_symbols)))
-
-            if len(price_symbols)>0:
-                print(f"pulling prices for {price_symbols} from {wallet_subtype.lower()}")
-                staked_assets = [asset for asset in price_symbols if asset.split('/')[0].endswith('.S')]
-                for staked_asset in staked_assets:
-                    price_symbols.remove(staked_asset)
-                price_symbols += [asset.replace('.S','') for asset in staked_assets]
-
-                valid_symbols = list(set(valid_symbols) & set(price_symbols))
-
-                print(f"valid for {wallet_subtype}: {valid_symbols}")
+    price_sources = [wallet_subtype for wallet_subtype in ['coingecko'] + list(wallet_dict['Wallets']['APIs'].keys())
+        if wallet_subtype.lower() in ['coingecko','coinbase','kraken','bittrex']
+    ]
+
+    # Create every price source up front and pull their valid assets/symbols concurrently
+    exchanges = {}
+    valid_calls = []
+    for wallet_subtype in price_sources:
+        if wallet_subtype.lower() in ['coingecko']:
+            exchanges[wallet_subtype] = exchange_classes[wallet_subtype.lower()]()
+            valid_calls += [exchanges[wallet_subtype].getValidAssets_Universal_async()]
+        elif wallet_subtype.lower() in ['coinbase','bittrex']:
+            exchanges[wallet_subtype] = exchange_classes[wallet_subtype.lower()]('', '')
+            valid_calls += [exchanges[wallet_subtype].getValidSymbols_Universal_async()]
+        elif wallet_subtype.lower() in ['kraken']:
+            exchanges[wallet_subtype] = exchange_classes[wallet_subtype.lower()]('', '')
+            valid_calls += [exchanges[wallet_subtype].run_async(exchanges[wallet_subtype].getSpotPairs_Universal)]
+    valid_results = dict(zip(price_sources, gather_async(valid_calls)))
+
+    for wallet_subtype in price_sources:
+        valid_result = valid_results[wallet_subtype]
+        if isinstance(valid_result, DeadlineExceeded) or (remaining_time() == 0):
+            report['missed_deadline'] += [wallet_subtype]
+            print(f"prices from {wallet_subtype.lower()} missed the refresh deadline")
+            continue
+        if isinstance(valid_result, Exception) or (valid_result is None):
+            print(f"could not load valid symbols from {wallet_subtype.lower()}: {valid_result}")
+            valid_result = []
+        if wallet_subtype.lower() in ['bittrex']:
+            valid_result = [symbol.replace('-','/') for symbol in valid_result]
+        if wallet_subtype.lower() in ['coinbase','kraken']:
+            subscribe_prices(wallet_subtype, [f'{bal}/{native}' for bal in symbols if f'{bal}/{native}' in valid_result])
+        if wallet_subtype.lower() in ['coingecko']:        
+            price_symbols = [bal for bal in symbols if f'{bal}/{native}' not in spot_df.columns]
+            spot_price_function = exchanges[wallet_subtype].getSymbolPrices
+            valid_symbols = list(set(set(valid_result) & set(price_symbols)))
+        elif wallet_subtype.lower() in ['coinbase','kraken','bittrex']:                    
+            price_symbols = [f'{bal}/{native}' for bal in symbols if f'{bal}/{native}' not in spot_df.columns]
+            spot_price_function = exchanges[wallet_subtype].getSpotPrices
+            valid_symbols = list(set(set(valid_result) & set(price_symbols)))
+
+        if len(price_symbols)>0:
+            print(f"pulling prices for {price_symbols} from {wallet_subtype.lower()}")
+            staked_assets = [asset for asset in price_symbols if asset.split('/')[0].endswith('.S')]
+            for staked_asset in staked_assets:
+                price_symbols.remove(staked_asset)
+            price_symbols += [asset.replace('.S','') for asset in staked_assets]
+
+            valid_symbols = list(set(valid_symbols) & set(price_symbols))
+
+            print(f"valid for {wallet_subtype}: {valid_symbols}")
+            try:
                 prices = spot_price_function(valid_symbols)
-                prices_df = pd.DataFrame(prices, index=[datetime.now().date()])                
-                for staked_asset in staked_assets:
-                    non_staked_asset = staked_asset.replace('.S','')
-                    if (f"{staked_asset}/{native}" not in prices_df.columns) and (f"{non_staked_asset}/{native}" in prices_df.columns) and (non_staked_asset != staked_asset):
-                        prices_df[f"{staked_asset}/{native}"] = prices_df[[f"{non_staked_asset}/{native}"]].copy()  
-
-
-                cols_to_append = list(prices_df.columns[~prices_df.columns.isin(list(spot_df.columns))])
-                spot_df = pd.concat([spot_df,prices_df[cols_to_append]],axis=1, sort=True, join='outer')               
+            except DeadlineExceeded:
+                report['missed_deadline'] += [wallet_subtype]
+                print(f"prices from {wallet_subtype.lower()} missed the refresh deadline")
+                continue
+            prices_df = pd.DataFrame(prices, index=[datetime.now().date()])                
+            for staked_asset in staked_assets:
+                non_staked_asset = staked_asset.replace('.S','')
+                if (f"{staked_asset}/{native}" not in prices_df.columns) and (f"{non_staked_asset}/{native}" in prices_df.columns) and (non_staked_asset != staked_asset):
+                    prices_df[f"{staked_asset}/{native}"] = prices_df[[f"{non_staked_asset}/{native}"]].copy()  
+
+
+            cols_to_append = list(prices_df.columns[~prices_df.columns.isin(list(spot_df.columns))])
+            spot_df = pd.concat([spot_df,prices_df[cols_to_append]],axis=1, sort=True, join='outer')               
 
     return spot_df
 
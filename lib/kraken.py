@@ -2,13 +2,14 @@ import hmac
 import hashlib
 import urllib
 import time
-import requests
 import pandas as pd
 import base64
+from requests.auth import AuthBase
 
-from config import fiat_currencies
-from lib.functions import decrypt, parse_pairs_from_series, rename_asset
-from lib.exchange import Exchange
+from config import fiat_currencies, remap_assets, kraken_ticker_max_pairs_length
+from lib.functions import parse_pairs_from_series, rename_asset
+from lib.exchange import Exchange, IncompletePages
+from lib.vault import credential_vault
 
 class Kraken(Exchange):
     def __init__(self, api_key, api_sec, key=''):
@@ -37,25 +38,60 @@ class Kraken(Exchange):
         postdata = urllib.parse.urlencode(data)
         encoded = (str(data['nonce']) + postdata).encode()
         message = uri_path.encode() + hashlib.sha256(encoded).digest()
-        mac = hmac.new(base64.b64decode(decrypt(self.api_sec,self.key)), message, hashlib.sha512)
+        # the secret is decrypted & base64 decoded once per session by the credential vault
+        mac = hmac.new(credential_vault.get(self.api_sec,self.key,base64.b64decode), message, hashlib.sha512)
         return base64.b64encode(mac.digest()).decode()
+
+    class WalletAuth(AuthBase):
+        def __init__(self, exchange, data):
+            self.exchange = exchange
+            self.data = data
+
+        def __call__(self, request):
+            """
+            Signs the request with a fresh nonce - requests calls this every time the request is sent, so a retried (throttled) request never replays a nonce
+
+            Args:
+                request (requests.PreparedRequest): API Request.
+
+            Returns:
+                requests.PreparedRequest: updated with the nonce in the body and authorized headers 
+            """
+            data = {**self.data, 'nonce': str(int(1000*time.time()))}
+            request.prepare_body(data, None)
+            request.headers.update({
+                'Api-Key': credential_vault.get(self.exchange.api_key,self.exchange.key),
+                'API-Sign': self.exchange.sign_request(request.path_url, data)
+            })
+            return request
             
-    def auth_request(self, uri_path, data={}):
+    def auth_request(self, uri_path, data={}, priority=0):
         """
         Submit an authenticated request to the API server
 
         Args:
             uri_path (str): sub path for the API call
             data (dict, optional): Data if necessary for the API call. Defaults to {}.
+            priority (int, optional): when requests to the host are queued, lower values are sent first. Defaults to 0.
 
         Returns:
             response: json response from the requests package (API)
         """
-        data['nonce']=str(int(1000*time.time()))
-        headers = {}
-        headers['Api-Key'] = decrypt(self.api_key,self.key)
-        headers['API-Sign'] = self.sign_request(uri_path, data)   
-        return requests.post(f"{self.api_url}{uri_path}", headers=headers, data=data)
+        auth = self.WalletAuth(self, data)
+        return self.http_request('POST', f"{self.api_url}{uri_path}", priority=priority, auth=auth)
+
+    @classmethod
+    def is_throttled(cls, resp):
+        """
+        Kraken reports throttling as a 200 response with a rate limit error
+
+        Args:
+            resp (response): response from the requests package
+
+        Returns:
+            bool: True if the response holds one of Kraken's rate limit errors
+        """
+        return (resp.status_code == 200) and any(err in resp.content for err in [b'EAPI:Rate limit exceeded', b'EGeneral:Too many requests'])
     
     def getBalances_Universal(self, refresh=False):
         """
@@ -94,7 +130,7 @@ class Kraken(Exchange):
             dict: response from the API, loaded into the self.validSymbols variable
         """
         if refresh or ('validSymbols' not in vars(self)):
-            resp = self.request('/0/public/AssetPairs')
+            resp = self.reference_request(f'{self.api_url}/0/public/AssetPairs', refresh=refresh)
             if resp.status_code == 200:
                 if 'result' in resp.json().keys():
                     self.validSymbols = resp.json()['result']
@@ -143,19 +179,83 @@ class Kraken(Exchange):
                 return self.validAssets_universal
         else: return self.validAssets_universal
 
-    def getHistoricalPrices(self, symbol):
+    def getSpotPairs_Universal(self, refresh=False):
+        """
+        Map universal symbols to the exchange pair names (uses the cached valid symbols from the AssetPairs API)
+        e.g. {'BTC/USD': 'XXBTZUSD'}
+        UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
+
+        Args:
+            refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+
+        Returns:
+            dict: {universal symbol: exchange pair name}, loaded into the self.spotPairs_universal variable
+        """
+        if refresh or ('spotPairs_universal' not in vars(self)):
+            validSymbols = self.getValidSymbols(refresh)
+            if validSymbols is not None:
+                spu = {}
+                for pair in validSymbols:
+                    if 'wsname' in validSymbols[pair].keys():
+                        symbol = '/'.join([remap_assets.get(asset, asset) for asset in validSymbols[pair]['wsname'].split('/')])
+                        spu[symbol] = pair
+                self.spotPairs_universal = spu
+                return self.spotPairs_universal
+        else: return self.spotPairs_universal
+
+    def getSpotPrices(self, symbols):
+        """
+        Get the current (last trade) prices for the symbols provided.
+        Pairs are requested together from the Ticker API, split into as few calls as the url length allows
+
+        Args:
+            symbols ([str]): trading symbols as XXX/XXX e.g. ['BTC/USD','ETH/USD']
+
+        Returns:
+            dict: {symbol: price} from the API
+        """
+        spotPairs = self.getSpotPairs_Universal()
+        if spotPairs is None:
+            return {}
+        pair_symbols = {spotPairs[symbol]: symbol for symbol in symbols if symbol in spotPairs.keys()}
+
+        chunks = [[]]
+        for pair in pair_symbols:
+            if len(','.join(chunks[-1]+[pair])) > kraken_ticker_max_pairs_length:
+                chunks += [[]]
+            chunks[-1] += [pair]
+
+        sp = {}
+        for chunk in [chunk for chunk in chunks if len(chunk)>0]:
+            resp = self.request(f"/0/public/Ticker?pair={','.join(chunk)}")
+            if resp.status_code == 200:
+                resp_json = resp.json()
+                if len(resp_json.get('error', []))>0:
+                    for err in resp_json['error']:
+                        print(f"error: {err}")
+                for pair in resp_json.get('result', {}):
+                    if pair in pair_symbols.keys():
+                        sp[pair_symbols[pair]] = float(resp_json['result'][pair]['c'][0])
+            else: print(f"bad response: {resp.status_code} from API")
+        return sp
+
+    def getHistoricalPrices(self, symbol, since=None):
         """
         Get the recent Historical prices for the provided symbol within the exchange via API call
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
 
         Returns:
             dict: response from the API
         """
         pair_split = symbol.split('/')
         symbol = pair_split[0] + pair_split[1]
-        resp = self.request(f'/0/public/OHLC?pair={symbol}&interval=1440')
+        uri_path = f'/0/public/OHLC?pair={symbol}&interval=1440'
+        if since is not None:
+            uri_path += f'&since={int(pd.Timestamp(since).timestamp())}'
+        resp = self.request(uri_path)
         if resp.status_code == 200: 
             if 'result' in resp.json().keys():
                 return resp.json()
@@ -164,17 +264,18 @@ class Kraken(Exchange):
                     print(f"error: {err}")
         else: print(f"bad response: {resp.status_code} from API")   
     
-    def getHistoricalPricesDataFrame(self,symbol):
+    def getHistoricalPricesDataFrame(self, symbol, since=None):
         """
         Get the recent Historical prices for the provided symbol within the exchange via API call
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
 
         Returns:
             pandas.DataFrame: response from the API
         """
-        historicalPrices = self.getHistoricalPrices(symbol)        
+        historicalPrices = self.getHistoricalPrices(symbol, since)        
         if historicalPrices is not None:    
             if 'result' in historicalPrices.keys():  
                 keys=[]
@@ -190,18 +291,19 @@ class Kraken(Exchange):
                 for err in historicalPrices['error']:
                     print(f"error: {err}")
     
-    def getHistoricalPricesDataFrame_Universal(self,symbol):
+    def getHistoricalPricesDataFrame_Universal(self, symbol, since=None):
         """
         Get the recent Historical prices for the provided symbol within the exchange via API call
         UNIVERSAL - the output will be the same for functions with other exchange classes with the same definition name
 
         Args:
             symbol (str): trading symbol as XXX/XXX
+            since (datetime, optional): only candles from this date onwards are required. Defaults to None (all recent candles).
 
         Returns:
             pandas.DataFrame: response from the API
         """
-        df = self.getHistoricalPricesDataFrame(symbol)
+        df = self.getHistoricalPricesDataFrame(symbol, since)
         if df is not None:
             if df.empty == False:
                 df[symbol] = (df['high'].astype(float)+df['low'].astype(float))/2  
@@ -256,7 +358,8 @@ class Kraken(Exchange):
         
     def parse_api_results(self,resp):
         """
-        Parse Ledger or Trade results into a formatted dataframe
+        Parse Ledger or Trade results into a formatted dataframe.
+        The frame is built once from the whole dict - numeric fields are typed and times converted in one vectorized pass
 
         Args:
             resp (dict): dictionary from the API json response
@@ -264,36 +367,104 @@ class Kraken(Exchange):
         Returns:
             pandas.DataFrame: formatted dataframe of the handled resp
         """
-        df = pd.DataFrame()
-        for result in resp:
-            temp_df = pd.DataFrame(resp[result], index=[result])
-            temp_df['time'] = pd.to_datetime(temp_df['time'], unit='s')
-            temp_df['date'] = temp_df.time.dt.date.astype('datetime64')
-            df = pd.concat([df,temp_df], axis=0)
+        if len(resp) == 0:
+            return pd.DataFrame()
+        df = pd.DataFrame.from_dict(resp, orient='index')
+        for col in ['vol', 'cost', 'fee', 'amount', 'price']:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col])
+        df['time'] = pd.to_datetime(pd.to_numeric(df['time']), unit='s')
+        df['date'] = df['time'].dt.normalize()
         return df
                   
-    def getTrades(self, refresh=False): 
+    def iterPages(self, uri_path, result_key, data={}):
         """
-        pulls the Trades associated with the API account on the exchange into a dataframe
+        Page through a private history API using the ofs (offset) parameter, yielding each page as it arrives
+        (the API returns at most 50 records per call)
+
+        Args:
+            uri_path (str): sub path for the API call e.g. '/0/private/Ledgers'
+            result_key (str): key of the records within the API result e.g. 'ledger'
+            data (dict, optional): Data if necessary for the API call. Defaults to {}.
+
+        Raises:
+            IncompletePages: a page could not be retrieved - the pages already yielded are not the full history
+
+        Yields:
+            pandas.DataFrame: formatted dataframe of each page of records
+        """
+        ofs = 0
+        while True:
+            resp = self.auth_request(uri_path, {**data, 'ofs': ofs}, priority=1)
+            if resp.status_code != 200:
+                raise IncompletePages(f"bad response: {resp.status_code} from API at offset {ofs}")
+            resp_json = resp.json()
+            if 'result' not in resp_json.keys():
+                raise IncompletePages(f"error: {resp_json.get('error', [])} at offset {ofs}")
+            records = resp_json['result'].get(result_key, {})
+            if len(records) == 0:
+                return
+            yield self.parse_api_results(records)
+            ofs += len(records)
+            if ofs >= int(resp_json['result'].get('count', 0)):
+                return
+
+    def syncHistory(self, name, uri_path, result_key, data={}, resync=False):
+        """
+        Bring a locally stored private history up to date.
+        Only records after the stored cursor (time of the newest stored record) are requested, 
+        then upserted into the stored history by transaction ID
+
+        Args:
+            name (str): history being synced e.g. 'trades'
+            uri_path (str): sub path for the API call e.g. '/0/private/TradesHistory'
+            result_key (str): key of the records within the API result e.g. 'trades'
+            data (dict, optional): Data if necessary for the API call. Defaults to {}.
+            resync (bool, optional): ignore the stored history and download it in full. Defaults to False.
+
+        Returns:
+            pandas.DataFrame: full history, newest first - the previously stored history if the sync did not complete
+        """
+        state = {} if resync else self.loadSyncState(name)
+        request_data = dict(data)
+        if 'cursor' in state.keys():
+            # start is exclusive - step back a second so records sharing the newest timestamp are not missed (duplicates are dropped below)
+            request_data['start'] = state['cursor'] - 1
+
+        try:
+            frames = list(self.iterPages(uri_path, result_key, request_data))
+        except IncompletePages as err:
+            # the missing pages are older than the newest record received - moving the cursor past them would skip them for good
+            print(f"{name} sync incomplete ({err}) - keeping the stored history and cursor")
+            return state.get('history')
+        if 'history' in state.keys():
+            frames += [state['history']]
+        if len(frames) == 0:
+            return None
+
+        df = pd.concat(frames, axis=0)
+        df = df[~df.index.duplicated(keep='first')]
+        if df.empty == False:
+            self.saveSyncState(name, {'history': df, 'cursor': int(df['time'].max().timestamp())})
+        return df
+
+    def getTrades(self, refresh=False, resync=False): 
+        """
+        pulls the Trades associated with the API account on the exchange into a dataframe. 
+        Trades are synced incrementally - only trades newer than those already stored are requested
 
         Args:
             refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+            resync (bool, optional): ignore the stored trades and download the full history. Defaults to False.
 
         Returns:
             pandas.DataFrame: response from the API, loaded into the self.walletTrades variable
         """            
         if refresh or ('walletTrades' not in vars(self)):   
-            resp = self.auth_request('/0/private/TradesHistory',{"trades": True})
-            if resp.status_code == 200:
-                if 'result' in resp.json().keys():
-                    if 'trades' in resp.json()['result'].keys():
-                        self.walletTrades = self.parse_api_results(resp.json()['result']['trades'])
-                        return self.walletTrades
-                elif 'error' in resp.json().keys():
-                    for err in resp.json()['error']:
-                        print(f"error: {err}")
-                else: print(f"no results in API response")
-            else: print(f"bad response: {resp.status_code} from API")
+            walletTrades = self.syncHistory('trades', '/0/private/TradesHistory', 'trades', {"trades": True}, resync)
+            if walletTrades is not None:
+                self.walletTrades = walletTrades
+                return self.walletTrades
         else: return self.walletTrades
                                                 
     def getTradesPairs(self, refresh=False):
@@ -310,29 +481,22 @@ class Kraken(Exchange):
         if walletTrades is not None:
             return parse_pairs_from_series(walletTrades,'pair',self.getValidAssets_Universal(refresh))       
     
-    def getLedger(self, refresh=False):
+    def getLedger(self, refresh=False, resync=False):
         """
-        pulls the ledger (excluding trades) associated with the API account on the exchange into a dataframe
+        pulls the ledger (excluding trades) associated with the API account on the exchange into a dataframe.
+        The ledger is synced incrementally - only entries newer than those already stored are requested
 
         Args:
             refresh (bool, optional): re-call the API function if the variable has not already been declared. Defaults to False.
+            resync (bool, optional): ignore the stored ledger and download the full history. Defaults to False.
 
         Returns:
             pandas.DataFrame: response from the API, loaded into the self.walletTrades variable
         """       
         if refresh or ('walletLedger' not in vars(self)):   
-            resp = self.auth_request('/0/private/Ledgers')
-            if resp.status_code == 200:
-                if 'result' in resp.json().keys():
-                    if 'ledger' in resp.json()['result'].keys():
-                        df = self.parse_api_results(resp.json()['result']['ledger'])
-                        if df.empty == False:
-                            df = df[df.type != 'trade']      
-                            self.walletLedger = df[df.type != 'trade'].copy()
-                            return self.walletLedger  
-                elif 'error' in resp.json().keys():
-                    for err in resp.json()['error']:
-                        print(f"error: {err}")
-            else: print(f"bad response: {resp.status_code} from API")
-        else: return self.walletLedger 
-                                                
\ No newline at end of file
+            df = self.syncHistory('ledger', '/0/private/Ledgers', 'ledger', {}, resync)
+            if df is not None:
+                if df.empty == False:
+                    self.walletLedger = df[df.type != 'trade'].copy()
+                    return self.walletLedger
+        else: return self.walletLedger
\ No newline at end of file
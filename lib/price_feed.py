@@ -0,0 +1,257 @@
+import abc
+import json
+import threading
+import time
+
+from config import remap_assets, price_feed_urls, price_feed_max_age, price_feed_reconnect_delay
+
+class PriceCache():
+    def __init__(self):
+        """
+        Thread-safe cache of the latest price seen for each symbol (kept up to date by the PriceFeed threads)
+        """
+        self.prices = {}
+        self.lock = threading.Lock()
+
+    def update(self, symbol, price):
+        """
+        Store the latest price of a symbol
+
+        Args:
+            symbol (str): universal symbol e.g. 'BTC/USD'
+            price (float): last trade price
+        """
+        with self.lock:
+            self.prices[symbol] = (float(price), time.time())
+
+    def get(self, symbols, max_age=price_feed_max_age):
+        """
+        Latest prices for the symbols which have been updated within max_age seconds
+
+        Args:
+            symbols ([str]): universal symbols e.g. ['BTC/USD','ETH/USD']
+            max_age (int, optional): seconds after which a cached price is ignored. Defaults to price_feed_max_age from config.py.
+
+        Returns:
+            dict: {symbol: price} for the symbols with a fresh price
+        """
+        now = time.time()
+        with self.lock:
+            return {symbol: self.prices[symbol][0] for symbol in symbols
+                if (symbol in self.prices.keys()) and ((now - self.prices[symbol][1]) <= max_age)}
+
+class PriceFeed(abc.ABC):
+    def __init__(self, name, url, cache):
+        """
+        Ticker WebSocket subscription run on a daemon thread - every ticker message updates the price cache.
+        The connection is re-opened (and all symbols re-subscribed) whenever it drops
+
+        Args:
+            name (str): feed name e.g. 'kraken'
+            url (str): WebSocket url (can point at a local stand-in server)
+            cache (PriceCache): cache the prices are written to
+        """
+        self.name = name
+        self.url = url
+        self.cache = cache
+        self.symbols = set()
+        self.lock = threading.Lock()
+        self.ws = None
+        self.thread = None
+        self.running = False
+
+    def subscribe(self, symbols):
+        """
+        Add symbols to the feed, starting the feed thread if it is not running yet
+
+        Args:
+            symbols ([str]): universal symbols e.g. ['BTC/USD','ETH/USD']
+        """
+        with self.lock:
+            new_symbols = sorted(set(symbols) - self.symbols)
+            self.symbols.update(new_symbols)
+            ws = self.ws
+        if (len(new_symbols) > 0) and (ws is not None):
+            try:
+                ws.send(json.dumps(self.subscribe_message(new_symbols)))
+            except Exception as e:
+                print(f"could not subscribe to {self.name} prices: {e}")
+        self.start()
+
+    def start(self):
+        """
+        Start the feed thread (does nothing if it is already running or websocket-client is not installed)
+        """
+        with self.lock:
+            if self.running:
+                return
+            try:
+                import websocket
+            except ImportError:
+                print("websocket-client is not installed - live prices are disabled")
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run, args=(websocket,), name=f'{self.name}-price-feed', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop the feed thread and close the connection
+        """
+        with self.lock:
+            self.running = False
+            ws = self.ws
+        if ws is not None:
+            ws.close()
+
+    def run(self, websocket):
+        """
+        Connection loop of the feed thread - reconnects after price_feed_reconnect_delay seconds (doubling up to a minute) while the feed is running
+
+        Args:
+            websocket (module): websocket-client module
+        """
+        delay = price_feed_reconnect_delay
+        while self.running:
+            try:
+                ws = websocket.create_connection(self.url, timeout=30)
+                with self.lock:
+                    self.ws = ws
+                    symbols = sorted(self.symbols)
+                if len(symbols) > 0:
+                    ws.send(json.dumps(self.subscribe_message(symbols)))
+                delay = price_feed_reconnect_delay
+                while self.running:
+                    message = ws.recv()
+                    if message in [None, '']:
+                        break
+                    for symbol, price in self.parse_message(json.loads(message)):
+                        self.cache.update(symbol, price)
+            except Exception as e:
+                if self.running:
+                    print(f"{self.name} price feed disconnected: {e}")
+            finally:
+                with self.lock:
+                    ws, self.ws = self.ws, None
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+            if self.running:
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    @abc.abstractmethod
+    def subscribe_message(self, symbols):
+        """
+        Subscribe message for the exchange's ticker channel - sent (JSON encoded) when the feed connects and when symbols are added
+
+        Args:
+            symbols ([str]): universal symbols e.g. ['BTC/USD']
+
+        Returns:
+            dict: subscribe message
+        """
+
+    @abc.abstractmethod
+    def parse_message(self, message):
+        """
+        Prices from a message received on the feed - messages which are not ticker updates (heartbeats, subscription status etc.) give no prices
+
+        Args:
+            message (list/dict): decoded WebSocket message
+
+        Returns:
+            list: [(universal symbol, price)]
+        """
+
+class KrakenPriceFeed(PriceFeed):
+    def subscribe_message(self, symbols):
+        """
+        Kraken ticker subscription - pairs use the exchange asset names e.g. 'XBT/USD'
+
+        Args:
+            symbols ([str]): universal symbols e.g. ['BTC/USD']
+
+        Returns:
+            dict: subscribe message
+        """
+        exchange_assets = {asset: exchange_asset for exchange_asset, asset in remap_assets.items()}
+        pairs = ['/'.join([exchange_assets.get(asset, asset) for asset in symbol.split('/')]) for symbol in symbols]
+        return {'event': 'subscribe', 'pair': pairs, 'subscription': {'name': 'ticker'}}
+
+    def parse_message(self, message):
+        """
+        Prices from a Kraken ticker message - [channelID, {'c': [price, volume], ...}, 'ticker', 'XBT/USD']
+
+        Args:
+            message (list/dict): decoded WebSocket message
+
+        Returns:
+            list: [(universal symbol, price)]
+        """
+        if isinstance(message, list) and (len(message) >= 4) and (message[-2] == 'ticker'):
+            symbol = '/'.join([remap_assets.get(asset, asset) for asset in message[-1].split('/')])
+            return [(symbol, message[1]['c'][0])]
+        return []
+
+class CoinbasePriceFeed(PriceFeed):
+    def subscribe_message(self, symbols):
+        """
+        Coinbase ticker subscription - products use '-' e.g. 'BTC-USD'.
+        The heartbeat channel is subscribed as well, so a pair without trades still sends a message every second and recv() does not time out
+
+        Args:
+            symbols ([str]): universal symbols e.g. ['BTC/USD']
+
+        Returns:
+            dict: subscribe message
+        """
+        return {'type': 'subscribe', 'product_ids': [symbol.replace('/','-') for symbol in symbols], 'channels': ['ticker', 'heartbeat']}
+
+    def parse_message(self, message):
+        """
+        Prices from a Coinbase ticker message - {'type': 'ticker', 'product_id': 'BTC-USD', 'price': '...'}
+
+        Args:
+            message (dict): decoded WebSocket message
+
+        Returns:
+            list: [(universal symbol, price)]
+        """
+        if isinstance(message, dict) and (message.get('type') == 'ticker') and ('price' in message.keys()):
+            return [(message['product_id'].replace('-','/'), message['price'])]
+        return []
+
+price_cache = PriceCache()
+feed_classes = {'kraken': KrakenPriceFeed, 'coinbase': CoinbasePriceFeed}
+feeds = {}
+feeds_lock = threading.Lock()
+
+def subscribe_prices(source, symbols):
+    """
+    Stream prices for the symbols from the source's ticker WebSocket into price_cache
+    (sources without a url in price_feed_urls from config.py are skipped)
+
+    Args:
+        source (str): 'kraken' or 'coinbase'
+        symbols ([str]): universal symbols e.g. ['BTC/USD','ETH/USD']
+    """
+    source = source.lower()
+    if (source not in feed_classes.keys()) or (price_feed_urls.get(source) in [None, '']) or (len(symbols) == 0):
+        return
+    with feeds_lock:
+        if source not in feeds.keys():
+            feeds[source] = feed_classes[source](source, price_feed_urls[source], price_cache)
+        feed = feeds[source]
+    feed.subscribe(symbols)
+
+def stop_price_feeds():
+    """
+    Stop every running price feed
+    """
+    with feeds_lock:
+        for feed in feeds.values():
+            feed.stop()
+        feeds.clear()
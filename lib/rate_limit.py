@@ -0,0 +1,95 @@
+import heapq
+import itertools
+import threading
+import time
+
+class TokenBucket():
+    def __init__(self, rate, capacity, min_rate=None):
+        """
+        Token bucket limiting the request rate to a host. Waiting requests are served in priority order (lowest first, then first come),
+        the rate is cut when the host throttles us and recovers gradually while requests succeed
+
+        Args:
+            rate (float): sustained requests per second
+            capacity (int): burst size - most requests that can be made back to back
+            min_rate (float, optional): floor for the rate when backing off. Defaults to a tenth of the rate.
+        """
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate/10
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def refill(self):
+        """
+        Add the tokens earned since the last refill (must be called holding the condition)
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=0, timeout=None):
+        """
+        Block until a token is available for this request and take it
+
+        Args:
+            priority (int, optional): lower values are served first. Defaults to 0.
+            timeout (float, optional): most seconds to wait for a token. Defaults to None (wait as long as it takes).
+
+        Returns:
+            bool: True once the token is taken, False if the timeout passed first
+        """
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    self.refill()
+                    now = time.monotonic()
+                    if (self.waiting[0] == ticket) and (self.tokens >= 1) and (now >= self.paused_until):
+                        heapq.heappop(self.waiting)
+                        self.tokens -= 1
+                        self.condition.notify_all()
+                        return True
+                    if (give_up_at is not None) and (now >= give_up_at):
+                        self.waiting.remove(ticket)
+                        heapq.heapify(self.waiting)
+                        self.condition.notify_all()
+                        return False
+                    wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.01)
+                    if give_up_at is not None:
+                        wait = min(wait, max(give_up_at - now, 0.01))
+                    self.condition.wait(wait)
+            except BaseException:
+                if ticket in self.waiting:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
+                raise
+
+    def backoff(self, retry_after=None):
+        """
+        The host throttled us - halve the rate and pause all requests for retry_after seconds (or until the next token)
+
+        Args:
+            retry_after (float, optional): seconds the host asked us to wait (Retry-After header). Defaults to None.
+        """
+        with self.condition:
+            self.rate = max(self.min_rate, self.rate/2)
+            self.tokens = 0
+            self.paused_until = time.monotonic() + (retry_after if retry_after is not None else 1/self.rate)
+            self.condition.notify_all()
+
+    def success(self):
+        """
+        A request went through - recover the rate step by step towards the configured rate
+        """
+        with self.condition:
+            if self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate + self.base_rate/10)
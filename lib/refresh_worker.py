@@ -0,0 +1,159 @@
+import hashlib
+import json
+import threading
+import time
+
+from config import refresh_deadline, refresh_interval, refresh_max_age, refresh_idle_timeout
+from lib.functions import balances_from_dict, pull_spot_prices_from_all_sources
+from lib.deadline import Deadline
+from lib.vault import credential_vault
+
+def refresh_portfolio(data, key, native='USD'):
+    """
+    Gather balances and spot prices for a wallet set (bounded by refresh_deadline from config.py)
+
+    Args:
+        data (dict): settings data stored in the id 'memory' - {'Wallets': {wallet_type: {wallet_subtype: [wallets]}}}
+        key (str): decryption key
+        native (str, optional): native currency prices are pulled in. Defaults to 'USD'.
+
+    Returns:
+        str: json panda dataframe object of the balance dataframe
+        str: json panda dataframe object of the prices dataframe
+        dict: refresh report - 'stale' (sources served from their last known good balances), 'failed' and 'missed_deadline' (see balances_from_dict)
+    """
+    # everything the refresh can gather within the deadline is kept, sources which missed it are reported
+    report = {}
+    with Deadline(refresh_deadline):
+        bal_df = balances_from_dict(data['Wallets'],key.encode(),report)
+        bal_df = bal_df.sort_values('Total', ascending=False)
+        price_symbols = [bal for bal in bal_df.index.values if bal != native]
+        prices_df = pull_spot_prices_from_all_sources(price_symbols, data, native=native, report=report)
+    if len(report['missed_deadline'])>0:
+        print(f"sources which missed the refresh deadline: {report['missed_deadline']}")
+    if len(report['stale'])>0:
+        print(f"sources served from their last known good balances: {list(report['stale'].keys())}")
+    if len(report['failed'])>0:
+        print(f"sources without balances: {report['failed']}")
+    return bal_df.to_json(), prices_df.to_json(), report
+
+class RefreshWorker():
+    def __init__(self, interval=refresh_interval, max_age=refresh_max_age, idle_timeout=refresh_idle_timeout):
+        """
+        Background worker which keeps the balances and prices of every wallet set the dashboard has asked for precomputed,
+        so callbacks only read the stored results
+
+        Args:
+            interval (int, optional): seconds between background refreshes of a wallet set. Defaults to refresh_interval from config.py.
+            max_age (int, optional): results older than this are refreshed before being returned. Defaults to refresh_max_age from config.py.
+            idle_timeout (int, optional): wallet sets which have not been read for this long stop being refreshed. Defaults to refresh_idle_timeout from config.py.
+        """
+        self.interval = interval
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.wallet_sets = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @staticmethod
+    def wallet_set_id(data, key):
+        """
+        Identifier of a wallet set - changes whenever the wallets or the key change
+
+        Args:
+            data (dict): settings data stored in the id 'memory'
+            key (str): decryption key
+
+        Returns:
+            str: sha256 hex digest
+        """
+        return hashlib.sha256((json.dumps(data['Wallets'], sort_keys=True) + key).encode()).hexdigest()
+
+    def get(self, data, key):
+        """
+        Precomputed balances and prices for the wallet set - computed now if there are no results or they are older than max_age
+
+        Args:
+            data (dict): settings data stored in the id 'memory'
+            key (str): decryption key
+
+        Returns:
+            str: json panda dataframe object of the balance dataframe
+            str: json panda dataframe object of the prices dataframe
+            dict: report of the refresh which produced them
+        """
+        set_id = self.wallet_set_id(data, key)
+        with self.lock:
+            if set_id not in self.wallet_sets.keys():
+                self.wallet_sets[set_id] = {'data': data, 'key': key, 'lock': threading.Lock()}
+            wallet_set = self.wallet_sets[set_id]
+            wallet_set['last_read'] = time.time()
+        self.start()
+        result = self.refresh(set_id, wallet_set, self.max_age)
+        return result['balance_df'], result['prices_df'], result['report']
+
+    def refresh(self, set_id, wallet_set, max_age):
+        """
+        Refresh a wallet set unless its results are younger than max_age (one refresh per wallet set runs at a time).
+        If the wallet set was forgotten while it refreshed, the results are discarded and the credentials it decrypted are dropped from the vault
+
+        Args:
+            set_id (str): wallet set identifier
+            wallet_set (dict): {'data', 'key', 'lock', 'last_read'}
+            max_age (int): seconds results are kept for
+
+        Returns:
+            dict: {'balance_df', 'prices_df', 'report', 'refreshed'}
+        """
+        with wallet_set['lock']:
+            with self.lock:
+                result = self.results.get(set_id)
+            if (result is None) or ((time.time() - result['refreshed']) >= max_age):
+                print(f"refreshing balances and prices for wallet set {set_id[:8]}")
+                balance_df, prices_df, report = refresh_portfolio(wallet_set['data'], wallet_set['key'])
+                result = {'balance_df': balance_df, 'prices_df': prices_df, 'report': report, 'refreshed': time.time()}
+                with self.lock:
+                    forgotten = self.wallet_sets.get(set_id) is not wallet_set
+                    if not forgotten:
+                        self.results[set_id] = result
+                if forgotten:
+                    credential_vault.clear(wallet_set['key'])
+            return result
+
+    def clear(self):
+        """
+        Forget every wallet set (and the decryption keys held for them) e.g. when the encryption key changes
+        """
+        with self.lock:
+            self.wallet_sets.clear()
+            self.results.clear()
+
+    def start(self):
+        """
+        Start the background thread if it is not running yet
+        """
+        with self.lock:
+            if (self.thread is None) or (not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run, name='refresh-worker', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        """
+        Background loop - refreshes every wallet set once its results are interval seconds old and drops idle wallet sets
+        """
+        while True:
+            now = time.time()
+            with self.lock:
+                for set_id in [set_id for set_id in self.wallet_sets if (now - self.wallet_sets[set_id]['last_read']) >= self.idle_timeout]:
+                    del self.wallet_sets[set_id]
+                    self.results.pop(set_id, None)
+                wallet_sets = list(self.wallet_sets.items())
+            for set_id, wallet_set in wallet_sets:
+                try:
+                    self.refresh(set_id, wallet_set, self.interval)
+                except Exception as e:
+                    print(f"background refresh of wallet set {set_id[:8]} failed: {e}")
+            time.sleep(min(self.interval, 10))
+
+refresh_worker = RefreshWorker()
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+
+from config import credential_ttl
+from lib.functions import decrypt
+
+class CredentialVault():
+    def __init__(self, ttl=credential_ttl):
+        """
+        In-memory cache of decrypted (and prepared) API credentials, so signed requests only pay for the HMAC.
+        Values are held in bytearrays which are zeroed when they expire or the vault is cleared
+
+        Args:
+            ttl (int, optional): seconds a decrypted credential is kept for. Defaults to credential_ttl from config.py.
+        """
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key_id(key):
+        """
+        Digest of a decryption key - credentials are grouped by it so one key's credentials can be dropped
+
+        Args:
+            key (bytes/str): decryption key
+
+        Returns:
+            bytes: sha256 digest
+        """
+        key = key.encode() if isinstance(key, str) else key
+        return hashlib.sha256(key).digest()
+
+    @classmethod
+    def entry_id(cls, ciphertext, key, prepare):
+        """
+        Identifier of a credential - digests, so neither the ciphertext nor the key are used as dictionary keys
+
+        Args:
+            ciphertext (bytes): encrypted credential
+            key (bytes): decryption key
+            prepare (function): function applied to the decrypted value (None for the raw value)
+
+        Returns:
+            tuple: (key digest, prepare function name, sha256 digest)
+        """
+        name = prepare.__name__ if prepare is not None else ''
+        return (cls.key_id(key), name, hashlib.sha256(key + b':' + ciphertext).digest())
+
+    def get(self, ciphertext, key='', prepare=None):
+        """
+        Decrypted credential - decrypted (and prepared) once, then served from memory until it expires
+
+        Args:
+            ciphertext (bytes/str): encrypted credential
+            key (bytes/str, optional): decryption key. Defaults to '' (prompts for one).
+            prepare (function, optional): applied once to the decrypted value e.g. base64.b64decode. Defaults to None.
+
+        Returns:
+            bytes: copy of the decrypted credential for this call - evicting the vault's copy (which is zeroed) never changes a key being signed with
+        """
+        ciphertext = ciphertext.encode() if isinstance(ciphertext, str) else ciphertext
+        key = key.encode() if isinstance(key, str) else key
+        entry_id = self.entry_id(ciphertext, key, prepare)
+        now = time.time()
+        with self.lock:
+            self.evict_expired(now)
+            if entry_id in self.entries.keys():
+                return bytes(self.entries[entry_id]['value'])
+        value = decrypt(ciphertext, key)
+        if prepare is not None:
+            value = prepare(value)
+        value = bytearray(value)
+        with self.lock:
+            entry = self.entries.setdefault(entry_id, {'value': value, 'expires': now + self.ttl})
+            if entry['value'] is not value:
+                # another thread stored the credential first - zero this copy
+                self.zero(value)
+            return bytes(entry['value'])
+
+    def evict_expired(self, now):
+        """
+        Zero and remove expired credentials (lock must be held)
+
+        Args:
+            now (float): current time
+        """
+        for entry_id in [entry_id for entry_id in self.entries if self.entries[entry_id]['expires'] <= now]:
+            self.zero(self.entries.pop(entry_id)['value'])
+
+    def clear(self, key=None):
+        """
+        Zero and remove every credential e.g. when the encryption key changes
+
+        Args:
+            key (bytes/str, optional): only remove the credentials decrypted with this key. Defaults to None (all credentials).
+        """
+        with self.lock:
+            for entry_id in [entry_id for entry_id in self.entries if (key is None) or (entry_id[0] == self.key_id(key))]:
+                self.zero(self.entries.pop(entry_id)['value'])
+
+    @staticmethod
+    def zero(value):
+        """
+        Overwrite a credential in place
+
+        Args:
+            value (bytearray): credential
+        """
+        for i in range(len(value)):
+            value[i] = 0
+
+credential_vault = CredentialVault()
@@ -0,0 +1,21 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.deadline import Deadline, remaining_time, run_in_context
+
+def test_run_in_context_executor_map_concurrent():
+    # every item blocks until all 4 are running at once, so the shared wrapper is entered from 4 threads together
+    barrier = threading.Barrier(4, timeout=5)
+    def remaining(_):
+        barrier.wait()
+        return remaining_time()
+
+    with Deadline(60):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(run_in_context(remaining), range(4)))
+
+    assert all((result is not None) and (0 < result <= 60) for result in results)
+
+def test_run_in_context_without_deadline():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(run_in_context(lambda _: remaining_time()), range(2))) == [None, None]